@@ -0,0 +1,160 @@
+"""
+Generator for synthetic patch note pages that mimic the structure of www.eveechoes.com/news/updata.
+
+The generated pages contain all the variations that the scraper and the formatter have to handle: The heading
+variants documented in formatter.replace_section_heading, lists made of paragraphs with ``margin-left: 40px``, nested
+divs, images, plain spans and <b> tags.
+"""
+import random
+from datetime import date, timedelta
+from typing import List, NamedTuple
+
+BASE_URL = "https://www.eveechoes.com/news/updata/"
+INDEX_URL = BASE_URL + "index{index}.html"
+
+WORDS = ["frigate", "cruiser", "battleship", "module", "damage", "shield", "armor", "structure", "corporation",
+         "alliance", "market", "skill", "blueprint", "planetary", "production", "mining", "asteroid", "detection",
+         "array", "event", "reward", "optimized", "fixed", "issue", "increased", "decreased", "weapon", "drone",
+         "capsuleer", "stargate", "sovereignty", "outpost", "faction", "warfare", "mission", "agent", "bounty"]
+
+HEADINGS = [
+    # <span><strong>Major</strong><br/>Minor</span>
+    '<p><span style="color:#FF8C00;"><strong>{major}</strong><br/>{minor}</span><br/>{text}</p>',
+    # <span>Minor</span>
+    '<p><span style="color:#FF8C00;">{minor}</span><br/>{text}</p>',
+    # <span><strong>Major</strong></span>
+    '<p><span style="color:#FF8C00;"><strong>{major}</strong></span><br/>{text}</p>',
+    # <span><em><strong>Major</strong></em></span>
+    '<p><span style="color:#FF8C00;"><em><strong>{major}</strong></em></span><br/>{text}</p>',
+    # <strong><span>Major</span></strong>
+    '<p><strong><span style="color:#FF8C00;">{major}</span></strong></p>\n<p>{text}</p>',
+]
+
+BLOCKS = [
+    '<p>{text}</p>',
+    '<p><span style="font-size:14px;">{text}</span></p>',
+    '<p>{text} <b>{word}</b> {text}</p>',
+    '<p>{text}&nbsp;{text}</p>',
+    '<div><div>{text}</div></div>',
+    '<div>{text}</div>',
+    '<div><span class="txt">{text}</span></div>',
+    '<div><p>{text}</p>\n<p>{text}</p></div>',
+    '<p align="center"><img src="//www.eveechoes.com/pic/{word}.jpg" alt="{word}"/></p>',
+]
+
+PAGE_HEAD = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="UTF-8">
+<title>{title} - EVE Echoes</title>
+<link rel="stylesheet" href="//www.eveechoes.com/css/news.css">
+<script>{script}</script>
+</head>
+<body>
+<div class="header"><ul class="nav">{nav}</ul></div>
+"""
+
+PAGE_TAIL = """<div class="footer">{footer}</div>
+</body>
+</html>
+"""
+
+
+class SyntheticNote(NamedTuple):
+    time: date
+    url: str
+    title: str
+    page: str
+
+
+def _text(rng: random.Random, min_words=6, max_words=25) -> str:
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return " ".join(words).capitalize() + "."
+
+
+def _title(rng: random.Random) -> str:
+    return " ".join(w.capitalize() for w in rng.choices(WORDS, k=rng.randint(1, 4)))
+
+
+def _page(title: str, body: str, rng: random.Random) -> str:
+    # Realistic pages contain a lot of markup that is irrelevant for the scraper
+    nav = "".join(f'<li><a href="//www.eveechoes.com/{w}/"><span>{w.capitalize()}</span></a></li>'
+                  for w in rng.sample(WORDS, 20))
+    footer = "".join(f'<p>{_text(rng)} <a href="//www.eveechoes.com/{w}.html">{w}</a></p>'
+                     for w in rng.sample(WORDS, 15))
+    script = "var config = {" + ", ".join(f'"{w}": {i}' for i, w in enumerate(WORDS * 10)) + "};"
+    return PAGE_HEAD.format(title=title, nav=nav, script=script) + body + PAGE_TAIL.format(footer=footer)
+
+
+def generate_content(rng: random.Random, sections: int) -> str:
+    """Generates the inner html of the ``div.artCon`` of a patch note"""
+    parts = []
+    for _ in range(sections):
+        parts.append(rng.choice(HEADINGS).format(major=_title(rng), minor=_title(rng), text=_text(rng)))
+        for _ in range(rng.randint(1, 4)):
+            if rng.random() < 0.4:
+                style = rng.choice(["margin-left: 40px;", "margin-left: 40px"])
+                parts.append("\n".join(f'<p style="{style}">{_text(rng, 3, 12)}</p>'
+                                       for _ in range(rng.randint(2, 6))))
+            else:
+                parts.append(rng.choice(BLOCKS).format(text=_text(rng), word=rng.choice(WORDS)))
+    return "\n".join(parts)
+
+
+def generate_patch_note_page(time: date, title: str, rng: random.Random, sections: int = 8) -> str:
+    body = (f'<div class="wrap">\n<div class="newDetail">\n'
+            f'<div class="title">{title}<p class="date">{time.isoformat()}</p></div>\n'
+            f'<div class="artCon">\n{generate_content(rng, sections)}\n</div>\n'
+            f'</div>\n</div>\n')
+    return _page(title, body, rng)
+
+
+def generate_notes(count: int, sections: int = 8, seed: int = 0, base_url: str = BASE_URL) -> List[SyntheticNote]:
+    """Generates ``count`` patch notes, the newest one first. Every note gets released one week after the last one."""
+    rng = random.Random(seed)
+    notes = []
+    time = date(2020, 8, 13) + timedelta(weeks=count)
+    for i in range(count):
+        time -= timedelta(weeks=1)
+        title = f"Patch Notes {time.strftime('%B %d')}: {_title(rng)}"
+        url = f"{base_url}{time.strftime('%Y%m%d')}/{100000 + count - i}.html"
+        page = generate_patch_note_page(time, title, rng, sections=max(1, sections + rng.randint(-2, 2)))
+        notes.append(SyntheticNote(time=time, url=url, title=title, page=page))
+    return notes
+
+
+def index_url(page: int, url_template: str = INDEX_URL) -> str:
+    return url_template.format(index="" if page == 1 else f"_{page}")
+
+
+def generate_listing_page(notes: List[SyntheticNote],
+                          page: int,
+                          last_page: int,
+                          url_template: str = INDEX_URL,
+                          seed: int = 0) -> str:
+    """Generates the overview page with the given patch notes and the pagination (including the "Last" link)"""
+    rng = random.Random(seed + page)
+    items = []
+    for note in notes:
+        items.append(f'<li class="item"><a href="{note.url}">'
+                     f'<div class="img"><img src="//www.eveechoes.com/pic/{rng.choice(WORDS)}.jpg"/></div>'
+                     f'<div class="txt"><p class="newTitle">{note.title}</p>'
+                     f'<p class="newDesc">{_text(rng)}</p>'
+                     f'<p class="newDate">{note.time.isoformat()}</p></div></a></li>')
+    pager = []
+    if page > 1:
+        pager.append(f'<a class="prev" href="{index_url(1, url_template)}"><span>First</span></a>')
+        pager.append(f'<a class="prev" href="{index_url(page - 1, url_template)}"><span>Prev</span></a>')
+    for i in range(max(1, page - 2), min(last_page, page + 2) + 1):
+        pager.append(f'<a class="num" href="{index_url(i, url_template)}">{i}</a>')
+    if page < last_page:
+        pager.append(f'<a class="next" href="{index_url(page + 1, url_template)}"><span>Next</span></a>')
+    # The scraper expects the "Last" link with the index_N pattern, even on the last page
+    pager.append(f'<a class="next" href="{url_template.format(index=f"_{last_page}")}"><span>Last</span></a>')
+    body = ('<div class="wrap">\n<ul class="newList">\n' + "\n".join(items) + '\n</ul>\n'
+            f'<div class="pageBox"><div class="pager">{"".join(pager)}</div></div>\n</div>\n')
+    return _page("News", body, rng)
+
+
+def paginate(notes: List[SyntheticNote], per_page: int = 10) -> List[List[SyntheticNote]]:
+    return [notes[i:i + per_page] for i in range(0, max(1, len(notes)), per_page)]
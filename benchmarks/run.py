@@ -0,0 +1,186 @@
+"""
+Benchmarks for the scraper parsing and the formatter throughput, based on a synthetic corpus.
+
+Usage:
+    python -m benchmarks.run -o results.json
+    python -m benchmarks.run -o new.json --compare results.json --threshold 0.2
+
+The results are saved as json. If a baseline is given, the run fails (exit code 1) if the median time of any benchmark
+got slower by more than the threshold (relative to the baseline).
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+from datetime import datetime
+from time import perf_counter
+from typing import Callable, Dict, List, Any
+
+from benchmarks import corpus
+from ee_patch_notes import scraper, formatter, storage, parser as html_parser
+
+logger = logging.getLogger("ee.bench")
+
+
+def measure(func: Callable[[], Any], repeat: int, items: int, size: int) -> Dict[str, float]:
+    """Calls func ``repeat`` times, ``items`` and ``size`` (bytes) are the amount of work done per call"""
+    func()  # warmup
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    median = statistics.median(times)
+    return {
+        "min": min(times),
+        "median": median,
+        "mean": statistics.mean(times),
+        "repeat": repeat,
+        "items": items,
+        "bytes": size,
+        "items_per_second": items / median if median > 0 else 0,
+        "mb_per_second": size / median / 1e6 if median > 0 else 0
+    }
+
+
+def run_benchmarks(notes_count: int, sections: int, repeat: int, seed: int) -> Dict[str, Dict[str, float]]:
+    notes = corpus.generate_notes(notes_count, sections=sections, seed=seed)
+    pages = corpus.paginate(notes)
+    listings = [corpus.generate_listing_page(p, i + 1, len(pages), seed=seed).encode("utf-8")
+                for i, p in enumerate(pages)]
+    detail_pages = [n.page.encode("utf-8") for n in notes]
+    results = {}
+
+    def _parse_listings():
+        for i, raw in enumerate(listings):
+            scraper.parse_patch_notes_list(raw, corpus.index_url(i + 1))
+
+    logger.info("Benchmarking extract_patch_notes_urls")
+    results["extract_patch_notes_urls"] = measure(
+        _parse_listings, repeat, len(listings), sum(len(r) for r in listings))
+
+    patch_notes = [scraper.PatchNote(url=n.url, time=n.time) for n in notes]
+
+    def _parse_details():
+        for patch_note, raw in zip(patch_notes, detail_pages):
+            scraper.extract_patch_note(patch_note, raw)
+
+    logger.info("Benchmarking download_patch_note (parsing)")
+    results["download_patch_note"] = measure(
+        _parse_details, repeat, len(detail_pages), sum(len(r) for r in detail_pages))
+
+    content_size = sum(len(p.content.encode("utf-8")) for p in patch_notes)
+
+    def _format():
+        for patch_note in patch_notes:
+            formatter.get_html(patch_note)
+
+    logger.info("Benchmarking get_html")
+    results["get_html"] = measure(_format, repeat, len(patch_notes), content_size)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        logger.info("Benchmarking export_html")
+        results["export_html"] = measure(
+            lambda: formatter.export_html(patch_notes, f"{tmp}/patch_notes.html"),
+            repeat, len(patch_notes), content_size)
+
+    contents = {p.time.isoformat(): p.content for p in patch_notes}
+    for name, create in STORAGES.items():
+        with tempfile.TemporaryDirectory() as tmp:
+            create(tmp).save_contents(contents)
+
+            def _load():
+                # A new instance every time, nothing is reused between the runs
+                target = create(tmp)
+                target.load_contents(contents.keys())
+                target.close()
+
+            logger.info("Benchmarking load_patch_notes_content (%s storage)", name)
+            results[f"load_content_{name}"] = measure(_load, repeat, len(contents), content_size)
+            results[f"load_content_{name}"]["disk_bytes"] = _disk_usage(tmp)
+    return results
+
+
+STORAGES = {
+    "files": lambda path: storage.FileStorage(path, f"{path}/cache.jsonl"),
+    "sqlite": lambda path: storage.SQLiteStorage(f"{path}/patch_notes.db"),
+    "pack": lambda path: storage.PackStorage(path, f"{path}/cache.jsonl")
+}  # type: Dict[str, Callable[[str], storage.Storage]]
+
+
+def _disk_usage(path: str) -> int:
+    return sum(os.path.getsize(f"{path}/{file_name}") for file_name in os.listdir(path))
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float) -> bool:
+    """Logs the change of every benchmark and returns False if any benchmark regressed more than the threshold"""
+    success = True
+    for name, result in results.items():
+        if name not in baseline:
+            logger.warning("Benchmark %s is missing in the baseline", name)
+            continue
+        change = result["median"] / baseline[name]["median"] - 1
+        regressed = change > threshold
+        (logger.error if regressed else logger.info)(
+            "%-26s %8.2f ms -> %8.2f ms (%+.1f%%)%s", name, baseline[name]["median"] * 1000,
+            result["median"] * 1000, change * 100, " REGRESSION" if regressed else "")
+        success = success and not regressed
+    return success
+
+
+def main(argv: List[str]) -> int:
+    arg_parser = argparse.ArgumentParser(description="Benchmarks for the patch notes scraper and formatter")
+    arg_parser.add_argument("-n", "--notes", type=int, default=100, help="The number of generated patch notes")
+    arg_parser.add_argument("-s", "--sections", type=int, default=8, help="The average number of sections per note")
+    arg_parser.add_argument("-r", "--repeat", type=int, default=5, help="How often every benchmark gets repeated")
+    arg_parser.add_argument("--seed", type=int, default=0, help="The seed for the corpus generator")
+    arg_parser.add_argument("-o", "--output", type=str, default=None, help="Save the results to this json file")
+    arg_parser.add_argument("-c", "--compare", type=str, default=None, help="A json file with baseline results")
+    arg_parser.add_argument("-t", "--threshold", type=float, default=0.2,
+                            help="The allowed relative slowdown compared to the baseline")
+    arg_parser.add_argument("-p", "--parser", choices=["auto"] + html_parser.PARSERS, default="auto",
+                            help="The html parser for the downloaded pages")
+    args = arg_parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s][%(levelname)s][%(name)s]: %(message)s")
+    # The scraper and formatter logging would distort the results
+    logging.getLogger("ee").setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+    html_parser.set_parser(args.parser)
+
+    results = run_benchmarks(args.notes, args.sections, args.repeat, args.seed)
+    for name, result in results.items():
+        logger.info("%-26s median %8.2f ms, %8.1f items/s, %6.2f MB/s%s",
+                    name, result["median"] * 1000, result["items_per_second"], result["mb_per_second"],
+                    f", {result['disk_bytes'] / 1e6:.2f} MB on disk" if "disk_bytes" in result else "")
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({
+                "meta": {
+                    "timestamp": datetime.now().isoformat(timespec="seconds"),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "parser": html_parser.HTML_PARSER,
+                    "formatter_parser": html_parser.FORMATTER_PARSER,
+                    "notes": args.notes,
+                    "sections": args.sections,
+                    "seed": args.seed
+                },
+                "results": results
+            }, file, indent=2)
+        logger.info("Saved results to %s", args.output)
+    if args.compare is not None:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+        if not compare(results, baseline, args.threshold):
+            logger.error("Benchmarks regressed by more than %.0f%%", args.threshold * 100)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
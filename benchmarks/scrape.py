@@ -0,0 +1,97 @@
+"""
+End-to-end benchmark of the scrape modes against the local test server.
+
+Every mode is executed via main.py in a separate process (exactly like a cron job would do it), the wall time gets
+compared with the lower bound that is caused by the rate limit.
+
+Usage:
+    python -m benchmarks.scrape -n 100 --latency 0.1 -r 0.2 -rd 0 -w 4 -o scrape.json
+"""
+import argparse
+import json
+import logging
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from typing import List, Dict, Any
+
+from benchmarks.server import PatchNoteServer
+
+logger = logging.getLogger("ee.bench")
+MAIN_PATH = (Path(__file__) / Path("../../main.py")).resolve()
+
+
+def run_mode(server: PatchNoteServer, mode: str, output_path: str, extra_args: List[str]) -> Dict[str, Any]:
+    requests_before = server.requests
+    errors_before = server.errors
+    start = perf_counter()
+    process = subprocess.run(
+        [sys.executable, str(MAIN_PATH), mode, output_path, "-url", server.url_template] + extra_args,
+        capture_output=True, text=True)
+    wall_time = perf_counter() - start
+    if process.returncode != 0:
+        logger.error("Mode %s failed:\n%s", mode, process.stdout[-2000:] + process.stderr[-2000:])
+    return {
+        "mode": mode,
+        "success": process.returncode == 0,
+        "wall_time": wall_time,
+        "requests": server.requests - requests_before,
+        "errors": server.errors - errors_before
+    }
+
+
+def main(argv: List[str]) -> int:
+    arg_parser = argparse.ArgumentParser(description="End-to-end benchmark of the scrape modes")
+    arg_parser.add_argument("-n", "--notes", type=int, default=100, help="The number of patch notes")
+    arg_parser.add_argument("--new", type=int, default=3, help="The number of new patch notes for load_new")
+    arg_parser.add_argument("--latency", type=float, default=0.05, help="The response delay of the server")
+    arg_parser.add_argument("--jitter", type=float, default=0.02, help="The random deviation of the delay")
+    arg_parser.add_argument("--error_rate", type=float, default=0, help="The probability for a 503 response")
+    arg_parser.add_argument("-r", "--ratelimit", type=float, default=0.1, help="The rate limit of the scraper")
+    arg_parser.add_argument("-rd", "--ratelimit_rnd_fac", type=float, default=0, help="The random rate limit factor")
+    arg_parser.add_argument("-w", "--workers", type=int, default=1, help="The number of download workers")
+    arg_parser.add_argument("-o", "--output", type=str, default=None, help="Save the results to this json file")
+    args, extra_args = arg_parser.parse_known_args(argv)
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s][%(levelname)s][%(name)s]: %(message)s")
+
+    server = PatchNoteServer(notes=args.notes - args.new, latency=args.latency, jitter=args.jitter,
+                             error_rate=args.error_rate)
+    server.start_background()
+    scrape_args = ["-r", str(args.ratelimit), "-rd", str(args.ratelimit_rnd_fac), "-w", str(args.workers)]
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            results.append(run_mode(server, "load_all", tmp, scrape_args + extra_args))
+            server.set_notes(args.notes)
+            results.append(run_mode(server, "load_new", tmp, scrape_args + extra_args))
+            results.append(run_mode(server, "load_new", tmp, scrape_args + extra_args))
+            results.append(run_mode(server, "export_html", tmp, extra_args))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    for result in results:
+        # Every request except the first one has to wait for the rate limit
+        result["rate_limit_bound"] = max(0, result["requests"] - 1) * args.ratelimit
+        logger.info("%-12s %s %7.2f s, %4s requests (%s errors), rate limit lower bound %7.2f s",
+                    result["mode"], "ok    " if result["success"] else "FAILED", result["wall_time"],
+                    result["requests"], result["errors"], result["rate_limit_bound"])
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({
+                "meta": {
+                    "timestamp": datetime.now().isoformat(timespec="seconds"),
+                    "args": vars(args),
+                    "extra_args": extra_args
+                },
+                "results": results
+            }, file, indent=2)
+        logger.info("Saved results to %s", args.output)
+    return 0 if all(r["success"] for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
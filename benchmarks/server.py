@@ -0,0 +1,172 @@
+"""
+Local stand-in for www.eveechoes.com/news/updata that serves a synthetic corpus.
+
+The server provides the paginated overview pages (``news/updata/index{index}.html``, including the "Last" link) and
+the patch note pages. Latency, jitter and an error rate can be injected to simulate a real server. The overview pages
+support conditional requests via ``ETag``.
+
+Usage:
+    python -m benchmarks.server --notes 300 --latency 0.1 --jitter 0.05 --error_rate 0.01
+    python main.py load_all data -url "http://127.0.0.1:8080/news/updata/index{index}.html"
+"""
+import argparse
+import hashlib
+import logging
+import random
+import re
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import sleep
+from typing import Dict, List, Optional
+
+from benchmarks import corpus
+
+logger = logging.getLogger("ee.server")
+
+RE_INDEX = re.compile(r"^/news/updata/index(?:_(\d+))?\.html$")
+RE_DETAIL = re.compile(r"^/news/updata/(\d{8})/(\d+)\.html$")
+
+
+class PatchNoteServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 0,
+                 notes: int = 100,
+                 per_page: int = 10,
+                 sections: int = 8,
+                 latency: float = 0,
+                 jitter: float = 0,
+                 error_rate: float = 0,
+                 seed: int = 0):
+        super().__init__((host, port), _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.per_page = per_page
+        self.sections = sections
+        self.seed = seed
+        self.base_url = f"http://{host}:{self.server_address[1]}/news/updata/"
+        self.url_template = self.base_url + "index{index}.html"
+        self.requests = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._pages = {}  # type: Dict[str, bytes]
+        self._notes = []  # type: List[corpus.SyntheticNote]
+        self.set_notes(notes)
+
+    def set_notes(self, count: int) -> None:
+        """Replaces the served patch notes, can be used to simulate newly released patch notes"""
+        notes = corpus.generate_notes(count, sections=self.sections, seed=self.seed, base_url=self.base_url)
+        pages = {}
+        listing = corpus.paginate(notes, self.per_page)
+        for i, page_notes in enumerate(listing):
+            raw = corpus.generate_listing_page(page_notes, i + 1, len(listing), self.url_template, seed=self.seed)
+            pages[corpus.index_url(i + 1, self.url_template)] = raw.encode("utf-8")
+        for note in notes:
+            pages[note.url] = note.page.encode("utf-8")
+        with self._lock:
+            self._notes = notes
+            self._pages = pages
+        logger.info("Serving %s patch notes on %s pages at %s", count, len(listing), self.url_template)
+
+    def edit_note(self, url: str, text: str = "Edited") -> None:
+        """Adds a paragraph to the content of a served patch note, simulates a patch note that gets edited later"""
+        with self._lock:
+            page = self._pages[url].decode("utf-8")
+            page = page.replace('<div class="artCon">\n', f'<div class="artCon">\n<p>{text}</p>\n', 1)
+            self._pages[url] = page.encode("utf-8")
+
+    @property
+    def last_page(self) -> int:
+        return max(1, (len(self._notes) + self.per_page - 1) // self.per_page)
+
+    def get_page(self, path: str) -> Optional[bytes]:
+        with self._lock:
+            return self._pages.get(self.base_url[:-len("/news/updata/")] + path)
+
+    def next_delay(self) -> float:
+        with self._lock:
+            self.requests += 1
+            return max(0.0, self.latency + self.jitter * (2 * self._rng.random() - 1))
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            return fail
+
+    def start_background(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, name="ee-server", daemon=True)
+        thread.start()
+        return thread
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: PatchNoteServer
+
+    def do_GET(self):
+        delay = self.server.next_delay()
+        if delay > 0:
+            sleep(delay)
+        if self.server.should_fail():
+            self._send(503, b"Service Unavailable", {"Retry-After": "1"})
+            return
+        if RE_INDEX.match(self.path) is None and RE_DETAIL.match(self.path) is None:
+            self._send(404, b"Not Found")
+            return
+        body = self.server.get_page(self.path)
+        if body is None:
+            self._send(404, b"Not Found")
+            return
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if RE_INDEX.match(self.path) is not None and self.headers.get("If-None-Match") == etag:
+            self._send(304, b"", {"ETag": etag})
+            return
+        self._send(200, body, {"ETag": etag, "Content-Type": "text/html; charset=utf-8"})
+
+    def _send(self, status: int, body: bytes, headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if len(body) > 0:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def main(argv: List[str]) -> int:
+    arg_parser = argparse.ArgumentParser(description="Local test server with synthetic patch notes")
+    arg_parser.add_argument("--host", type=str, default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8080)
+    arg_parser.add_argument("-n", "--notes", type=int, default=100, help="The number of patch notes")
+    arg_parser.add_argument("--per_page", type=int, default=10, help="The number of patch notes per overview page")
+    arg_parser.add_argument("-s", "--sections", type=int, default=8, help="The average number of sections per note")
+    arg_parser.add_argument("--latency", type=float, default=0, help="The response delay in seconds")
+    arg_parser.add_argument("--jitter", type=float, default=0, help="The maximum random deviation of the delay")
+    arg_parser.add_argument("--error_rate", type=float, default=0, help="The probability for a 503 response")
+    arg_parser.add_argument("--seed", type=int, default=0, help="The seed for the corpus generator")
+    args = arg_parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s][%(levelname)s][%(name)s]: %(message)s")
+
+    server = PatchNoteServer(host=args.host, port=args.port, notes=args.notes, per_page=args.per_page,
+                             sections=args.sections, latency=args.latency, jitter=args.jitter,
+                             error_rate=args.error_rate, seed=args.seed)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
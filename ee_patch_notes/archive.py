@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, Optional, Any
+
+from requests import Response
+
+logger = logging.getLogger("ee.archive")
+
+
+class ResponseArchive:
+    """
+    Append-only archive of the fetched http responses, so the downloaded pages can be processed again without
+    sending any requests.
+
+    The response bodies are saved zlib compressed in ``responses.pack``, the journal ``responses.jsonl`` contains one
+    record per response with the url, the status, the headers, the time of the request and the position of the body
+    in the pack file. A body that is identical to the last archived body of the same url is not saved again, responses
+    without a body only get a journal record. A 304 Not Modified response is archived with the body from the http
+    cache, so the page can be replayed.
+    """
+
+    def __init__(self, path: str, level: int = 6):
+        self.path = path
+        self.pack_path = f"{path}/responses.pack"
+        self.journal_path = f"{path}/responses.jsonl"
+        self.level = level
+        self.records = 0
+        self._lock = threading.Lock()
+        # The last successful response with a body for every url
+        self._latest = {}  # type: Dict[str, Dict[str, Any]]
+        os.makedirs(path, exist_ok=True)
+        self._read_journal()
+
+    def _read_journal(self) -> None:
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Only the last record can be incomplete (if a write was interrupted)
+                    logger.warning("Skipping incomplete record in %s", self.journal_path)
+                    continue
+                self.records += 1
+                if record["status"] in (200, 304) and record["offset"] is not None:
+                    self._latest[record["url"]] = record
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._latest
+
+    def record(self, url: str, response: Response, not_modified: bool = False) -> None:
+        """
+        Archives the response, not_modified marks a 304 response that was filled with the body of the http cache (the
+        record keeps the status 304)
+        """
+        body = response.content or b""
+        record = {
+            "url": url,
+            "status": 304 if not_modified else response.status_code,
+            "headers": dict(response.headers),
+            "fetched_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "offset": None,
+            "length": 0,
+            "hash": hashlib.sha256(body).hexdigest() if len(body) > 0 else None
+        }
+        with self._lock:
+            if len(body) > 0:
+                latest = self._latest.get(url)
+                if latest is not None and latest["hash"] == record["hash"]:
+                    record["offset"], record["length"] = latest["offset"], latest["length"]
+                else:
+                    data = zlib.compress(body, self.level)
+                    with open(self.pack_path, "ab") as file:
+                        record["offset"] = file.seek(0, os.SEEK_END)
+                        file.write(data)
+                    record["length"] = len(data)
+                if response.status_code == 200:
+                    self._latest[url] = record
+            with open(self.journal_path, "rb+" if os.path.exists(self.journal_path) else "wb") as file:
+                # Don't continue an incomplete record of an interrupted write
+                if file.seek(0, os.SEEK_END) > 0:
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b"\n":
+                        file.write(b"\n")
+                file.write((json.dumps(record) + "\n").encode("utf-8"))
+            self.records += 1
+
+    def load(self, url: str) -> Optional[Response]:
+        """Returns the last archived successful response for the url, None if there is none"""
+        with self._lock:
+            record = self._latest.get(url)
+            if record is None:
+                return None
+            with open(self.pack_path, "rb") as file:
+                file.seek(record["offset"])
+                data = file.read(record["length"])
+        response = Response()
+        # A replayed 304 response carries the cached body, it is served like the original page
+        response.status_code = 200
+        response.headers.update(record["headers"])
+        response.url = url
+        response._content = zlib.decompress(data)
+        response.from_archive = True
+        return response
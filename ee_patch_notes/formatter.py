@@ -1,15 +1,42 @@
 import datetime
+import hashlib
+import html
+import inspect
+import json
 import logging
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
 from pathlib import Path
-from typing import List, Union, Optional
+from time import perf_counter
+from typing import List, Union, Optional, Tuple, Iterable, Iterator, Set, Deque, Dict, Callable, Any
 
-from bs4 import BeautifulSoup, Tag, PageElement, NavigableString
+from bs4 import BeautifulSoup, Tag, PageElement, NavigableString, Comment
 
-from ee_patch_notes.scraper import PatchNote
+from ee_patch_notes import parser, search, structure
+from ee_patch_notes.fragments import FragmentCache
+from ee_patch_notes.metrics import registry as metrics
+from ee_patch_notes.scraper import PatchNote, load_patch_note_content, get_storage
+from ee_patch_notes.storage import content_hash
 
 
 logger = logging.getLogger("ee.export")
 TEXT_TAGS = ["span", "em", "strong"]
+# Has to be increased whenever the output of get_html changes, otherwise outdated cached fragments will be used
+FORMATTER_VERSION = "3"
+PATCH_NOTES_MARKER = "patch-notes-content"
+SEARCH_INDEX_MARKER = "__SEARCH_INDEX__"
+TEMPLATE_PATH = (Path(__file__) / Path("../../resources/patch_notes_template.html")).resolve()
+INDEX_PAGE = "index.html"
+SHARD_MANIFEST = "shards.json"
+EXPORT_TITLE = "Eve Echoes Patch Notes"
+# The number of patch notes in the feed
+FEED_SIZE = 20
+# Atom requires an author, the entries inherit the author of the feed
+FEED_AUTHOR = "Eve Echoes"
+_EXTRACT_HAS_INDEX = "_self_index" in inspect.signature(PageElement.extract).parameters
+RE_MARKDOWN_SPECIAL = re.compile(r"([\\`*_\[\]<>#|])")
 
 
 class FormattingException(Exception):
@@ -40,7 +67,7 @@ def _get_first_real_element(
 
 
 # noinspection PyTypeChecker,PyUnresolvedReferences
-def replace_section_heading(tag: Tag, soup: BeautifulSoup):
+def replace_section_heading(tag: Tag, soup: BeautifulSoup) -> List[Tag]:
     # The heading scheme is inconsistent, there are these variations:
     # <span style="color:#FF8C00;">
     #  <strong>Major Heading</strong>
@@ -139,13 +166,14 @@ def replace_section_heading(tag: Tag, soup: BeautifulSoup):
                 outer_tag = t
 
     if outer_tag is None or not _is_end_of_paragraph(outer_tag):
-        return
+        return []
     if inner_tag.name == "strong" or (middle_tag and middle_tag.name == "strong") or outer_tag.name == "strong":
         major = inner_tag.contents[0]
     else:
         minor = inner_tag.contents[0]
 
     major_heading = None
+    minor_heading = None
     last_el = None
     if major:
         major_heading = soup.new_tag("h3")
@@ -164,6 +192,7 @@ def replace_section_heading(tag: Tag, soup: BeautifulSoup):
     if next_el is not None and next_el.name == "br":
         next_el.decompose()
     outer_tag.decompose()
+    return [h for h in (major_heading, minor_heading) if h is not None]
 
 
 def remove_div(div: Tag, soup: BeautifulSoup):
@@ -192,15 +221,28 @@ def remove_div(div: Tag, soup: BeautifulSoup):
         div.unwrap()
 
 
+def _extract_at(element: PageElement, index: int) -> PageElement:
+    # PageElement.extract() searches the element in its parent linearly. The private _self_index argument of bs4 4.x
+    # (the version is pinned in requirements.txt) skips this search, the index is only passed if it is correct and
+    # the installed bs4 supports it.
+    if _EXTRACT_HAS_INDEX and element.parent.contents[index] is element:
+        return element.extract(_self_index=index)
+    return element.extract()
+
+
 def replace_with_ul(tag: Tag, soup: BeautifulSoup):
     ul = soup.new_tag("ul", style="list-style-type: square;")
     tag.insert_before(ul)
+    # The list items are always directly after the <ul>, passing their index to extract() saves a linear search
+    # through the parent for every item (which is slow for large patch notes)
+    item_index = tag.parent.index(ul) + 1
     p = tag
     i = 0
     while p.name == "p" and "margin-left: 40px" in p.get("style", ""):
         n = p.next_sibling
         li = soup.new_tag("li")
         ul.insert(i, li)
+        _extract_at(p, item_index)
         li.insert(0, p)
         p.unwrap()
         i += 1
@@ -210,13 +252,13 @@ def replace_with_ul(tag: Tag, soup: BeautifulSoup):
 def extract_heading(heading: Tag, soup: BeautifulSoup):
     prev_p = heading.parent
     next_p = soup.new_tag("p")
-    i = 0
+    # All following elements are moved into the new paragraph, they are always directly after the heading
+    next_index = prev_p.index(heading) + 1
     tag = heading.next_sibling
     while tag is not None:
         n_tag = tag.next_sibling
-        next_p.insert(i, tag)
+        next_p.append(_extract_at(tag, next_index))
         tag = n_tag
-        i += 1
     prev_p.insert_after(heading)
     heading.insert_after(next_p)
     if len(prev_p.contents) == 0 or _get_first_real_element(contents=prev_p.contents) is None:
@@ -225,15 +267,100 @@ def extract_heading(heading: Tag, soup: BeautifulSoup):
         next_p.decompose()
 
 
+# The formatting rules are registered per tag name for one of the phases. All rules of a phase get applied during a
+# single traversal of the patch note (in document order).
+# Phase 1: Before the divs get removed
+PHASE_CLEANUP = 1
+# Phase 2: After the divs got removed
+PHASE_STRUCTURE = 2
+_RULES = {
+    PHASE_CLEANUP: {},
+    PHASE_STRUCTURE: {}
+}  # type: Dict[int, Dict[str, List[Callable[[Tag, _FormatContext], None]]]]
+
+
+class _FormatContext:
+    def __init__(self, soup: BeautifulSoup):
+        self.soup = soup
+        # The colored spans that might be section headings, they get replaced after all rules were applied
+        self.heading_spans = []  # type: List[Tag]
+        # All h3/h4 headings, they get moved out of their paragraphs at the end
+        self.headings = []  # type: List[Tag]
+
+
+def rule(phase: int, *names: str):
+    """Registers the decorated function as formatting rule for the given tag names"""
+    def _decorator(func: Callable[[Tag, _FormatContext], None]):
+        for name in names:
+            _RULES[phase].setdefault(name, []).append(func)
+        return func
+    return _decorator
+
+
+def _apply_rules(soup: BeautifulSoup, phase: int, context: _FormatContext):
+    rules = _RULES[phase]
+    # Snapshot of the matching tags, the rules may change the tree. Filtering the descendants directly is a lot
+    # faster than find_all with a list of names.
+    tags = [t for t in soup.descendants if t.name in rules]  # type: List[Tag]
+    for tag in tags:
+        for r in rules.get(tag.name, []):
+            r(tag, context)
+
+
+@rule(PHASE_CLEANUP, "img")
+def _remove_image(img_tag: Tag, _context: _FormatContext):
+    # Delete all images (older patch notes did contain <img> tags)
+    img_tag.replaceWith("")
+
+
+@rule(PHASE_CLEANUP, "span")
+def _remove_span(span_tag: Tag, context: _FormatContext):
+    # Remove unnecessary spans
+    # There is also one patch note that is using #FFA500 as color
+    if "color" not in span_tag.get("style", default="") or "#FF8C00" not in span_tag.get("style"):
+        span_tag.unwrap()
+    else:
+        context.heading_spans.append(span_tag)
+    if span_tag.get("class") is not None:
+        del span_tag["class"]
+
+
+@rule(PHASE_STRUCTURE, "p")
+def _clean_paragraph(p_tag: Tag, context: _FormatContext):
+    if p_tag.get("style") is not None:
+        if p_tag.decomposed:
+            return
+        if "margin-left: 40px" in p_tag.get("style"):
+            replace_with_ul(p_tag, context.soup)
+        del p_tag["style"]
+    if p_tag.get("class") is not None and len(p_tag["class"]) != 1 and p_tag["class"][0] != "date":
+        del p_tag["class"]
+    if p_tag.get("align") is not None:
+        del p_tag["align"]
+
+
+@rule(PHASE_STRUCTURE, "b")
+def _replace_bold(b_tag: Tag, _context: _FormatContext):
+    b_tag.name = "strong"
+
+
+@rule(PHASE_STRUCTURE, "h3", "h4")
+def _register_heading(heading: Tag, context: _FormatContext):
+    context.headings.append(heading)
+
+
 def get_html(patch_note: PatchNote) -> PageElement:
     if patch_note.content is None:
         raise FormattingException(f"Patch note {patch_note} does not have any content")
-    soup = BeautifulSoup(patch_note.content.replace(" ", " "), "html.parser")  # .replace(" ", " ")
-    # soup2 = BeautifulSoup(patch_note.content.replace(" ", " "), "html.parser")
-
-    # Delete all images (older patch notes did contain <img> tags)
-    for img_tag in soup.find_all("img"):  # type: Tag
-        img_tag.replaceWith("")
+    soup = patch_note.parsed
+    if soup is not None:
+        # The tree of a downloaded patch note gets modified by the formatting, it can only be used once
+        patch_note.parsed = None
+        for string in soup.find_all(string=lambda text: " " in text):
+            string.replace_with(type(string)(string.replace(" ", " ")))
+    else:
+        soup = parser.parse_patch_note(patch_note.content.replace(" ", " "))  # .replace(" ", " ")
+    # soup2 = BeautifulSoup(patch_note.content.replace(" ", " "), "html.parser")
 
     # Basic setup
     # noinspection PyTypeChecker
@@ -244,49 +371,51 @@ def get_html(patch_note: PatchNote) -> PageElement:
     content = tag.find("div", class_="artCon")
     content["class"] = "patch-content"
 
-    # Remove unnecessary spans
-    for span_tag in soup.find_all("span"):  # type: Tag
-        # There is also one patch note that is using #FFA500 as color
-        if "color" not in span_tag.get("style", default="") or "#FF8C00" not in span_tag.get("style"):
-            span_tag.unwrap()
-        if span_tag.get("class") is not None:
-            del span_tag["class"]
+    context = _FormatContext(soup)
+    _apply_rules(soup, PHASE_CLEANUP, context)
 
     # Replace/remove divs
     for div_tag in content.find_all("div", recursive=False):
         remove_div(div_tag, soup)
 
-    for p_tag in soup.find_all("p"):  # type: Tag
-        if p_tag.get("style") is not None:
-            if p_tag.decomposed:
-                continue
-            if "margin-left: 40px" in p_tag.get("style"):
-                replace_with_ul(p_tag, soup)
-            del p_tag["style"]
-        if p_tag.get("class") is not None and len(p_tag["class"]) != 1 and p_tag["class"][0] != "date":
-            del p_tag["class"]
-        if p_tag.get("align") is not None:
-            del p_tag["align"]
-    for tag in soup.find_all("b"):
-        tag.name = "strong"
+    _apply_rules(soup, PHASE_STRUCTURE, context)
 
     # Find subheadings
-    for span_tag in soup.find_all("span"):  # type: Tag
-        if "color" not in span_tag.get("style", default=""):
-            continue
+    for span_tag in context.heading_spans:
         # ToDo: Maybe handle pre-2021-10-11 patch notes (uncolored headings)
-        replace_section_heading(span_tag, soup)
+        context.headings.extend(replace_section_heading(span_tag, soup))
     # ToDo: Cleanup Headings and divs, see 2022-04-02
-    for p_tag in soup.find_all("p"):
+    paragraphs = {}  # type: Dict[int, Tag]
+    for heading in context.headings:
+        if heading.parent is not None and heading.parent.name == "p":
+            # Tags with the same content are equal, the identity has to be used as key
+            paragraphs.setdefault(id(heading.parent), heading.parent)
+    for p_tag in paragraphs.values():
         for heading in p_tag.find_all(["h3", "h4"], recursive=False):
             extract_heading(heading, soup)
+    # Anchors for linking to the sections (used by the search)
+    for i, heading in enumerate(content.find_all(["h3", "h4"])):
+        heading["id"] = f"patch-note-{patch_note.time.isoformat()}-{i + 1}"
     return soup.contents[0]
 
 
-def export_html(patch_notes: List[PatchNote], path: str):
+def render_note(patch_note: PatchNote) -> Dict[str, Any]:
+    """
+    Formats the patch note, returns the html, the search index entries (see search.extract_entries) and the structure
+    of the patch note (see structure.extract_structure)
+    """
+    tag = get_html(patch_note)
+    return {
+        "html": tag.prettify(),
+        "search": search.extract_entries(tag),
+        "data": structure.extract_structure(tag)
+    }
+
+
+def _load_template() -> Tuple[str, str, str]:
+    """Returns the part of the template before the patch notes, before the search index and after the search index"""
     logger.info("Loading html template")
-    file_path = (Path(__file__) / Path("../../resources/patch_notes_template.html")).resolve()
-    with open(file_path, "r", encoding="utf-8") as file:
+    with open(TEMPLATE_PATH, "r", encoding="utf-8") as file:
         template_raw = file.read()
     template = BeautifulSoup(template_raw, "html.parser")
     # template = template.replace("{time_updated}", datetime.datetime.now().isoformat(sep=" ", timespec="minutes"))
@@ -295,16 +424,502 @@ def export_html(patch_notes: List[PatchNote], path: str):
     tag_time = template.find("br", id="timestamp", recursive=True)
     tag_time.replaceWith(datetime.datetime.now().isoformat(sep=" ", timespec="minutes"))
     div_patch_notes = template.find("div", id="patch-notes", recursive=True)
-
-    num_notes = len(patch_notes)
+    div_patch_notes.append(Comment(PATCH_NOTES_MARKER))
+    template.find("script", id="search-index", recursive=True).string = SEARCH_INDEX_MARKER
+    head, tail = template.prettify().split(f"<!--{PATCH_NOTES_MARKER}-->")
+    middle, tail = tail.split(SEARCH_INDEX_MARKER)
+    return head, middle, tail
+
+
+def get_version() -> str:
+    """Returns the version of the formatting logic, including the parser as it affects the result"""
+    return f"{FORMATTER_VERSION}-{parser.FORMATTER_PARSER}"
+
+
+def _render_note_worker(url: str,
+                        time: datetime.date,
+                        content: str,
+                        parser_name: str) -> Tuple[Dict[str, Any], float]:
+    # Runs in a worker process, only the raw values get transferred to keep the pickling cheap. The metrics of the
+    # worker process are lost, therefore the duration gets returned.
+    parser.FORMATTER_PARSER = parser_name
+    patch_note = PatchNote(url=url, time=time)
+    patch_note.content = content
+    start = perf_counter()
+    result = render_note(patch_note)
+    return result, perf_counter() - start
+
+
+def _iter_fragments(patch_notes: Iterable[PatchNote],
+                    fragment_cache: Optional[FragmentCache],
+                    workers: int,
+                    used_keys: Set[str]) -> Iterator[Dict[str, Any]]:
+    """
+    Yields the formatting results (see render_note) of the patch notes in the given order. The content of a patch
+    note is loaded from disk only for formatting it (if it wasn't loaded before), saved content gets released
+    afterward. With a process pool only a small window of patch notes is in progress at the same time.
+    """
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    max_pending = workers * 2 if executor is not None else 0
+    pending = deque()  # type: Deque[Tuple[str | None, Dict[str, Any] | Future]]
+
+    def _finish():
+        key, fragment = pending.popleft()
+        if isinstance(fragment, Future):
+            fragment, duration = fragment.result()
+            metrics.observe("format_note", duration)
+            if fragment_cache is not None:
+                fragment_cache.put(key, fragment)
+        return fragment
+
+    try:
+        for patch_note in patch_notes:
+            loaded = not patch_note.content_loaded
+            if loaded:
+                load_patch_note_content(patch_note)
+            key = None
+            fragment = None
+            if fragment_cache is not None:
+                key = fragment_cache.key(patch_note.time.isoformat(), patch_note.content)
+                used_keys.add(key)
+                fragment = fragment_cache.get(key)
+            if fragment is None:
+                if executor is None:
+                    with metrics.timer("format_note"):
+                        fragment = render_note(patch_note)
+                    if fragment_cache is not None:
+                        fragment_cache.put(key, fragment)
+                else:
+                    fragment = executor.submit(_render_note_worker,
+                                               patch_note.url, patch_note.time, patch_note.content,
+                                               parser.FORMATTER_PARSER)
+            patch_note.parsed = None
+            # Saved content can be loaded again, this includes the patch notes that were just downloaded
+            if patch_note.content_saved:
+                patch_note.release_content()
+            pending.append((key, fragment))
+            while len(pending) > max_pending:
+                yield _finish()
+        while len(pending) > 0:
+            yield _finish()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _write(file, text: str) -> None:
+    with metrics.timer("export_write"):
+        metrics.inc("export_characters", file.write(text))
+
+
+def _serialize_index(search_index: search.SearchIndexBuilder) -> str:
+    with metrics.timer("search_index"):
+        return search_index.to_json()
+
+
+def _json_record(patch_note: PatchNote, result: Dict[str, Any]) -> str:
+    record = {"date": patch_note.time.isoformat(), "url": patch_note.url}
+    record.update(result["data"])
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+class ExportWriter:
+    """
+    Writes the formatted patch notes (see render_note) of an export in one output format, the patch notes are passed
+    newest first. The output is written into a temporary file that replaces the target file once the export is
+    finished, so an interrupted export keeps the previous file.
+    """
+    # The number of the newest patch notes the writer needs, None for all patch notes
+    limit = None  # type: Optional[int]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.file = None
+
+    def open(self) -> None:
+        self.file = open(self.tmp_path, "w", encoding="utf-8")
+        self.write_head()
+
+    def write_head(self) -> None:
+        pass
+
+    def write_note(self, patch_note: PatchNote, result: Dict[str, Any]) -> None:
+        raise NotImplementedError()
+
+    def write_tail(self) -> None:
+        pass
+
+    def finish(self) -> None:
+        self.write_tail()
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def close(self) -> None:
+        if self.file is not None and not self.file.closed:
+            self.file.close()
+
+
+class HtmlWriter(ExportWriter):
+    """The patch notes inserted into the html template, with the search index over all written patch notes"""
+
+    def __init__(self, path: str, template: Optional[Tuple[str, str, str]] = None, nav: str = ""):
+        super().__init__(path)
+        self.template = template
+        self.nav = nav
+        self.search_index = search.SearchIndexBuilder()
+
+    def write_head(self) -> None:
+        if self.template is None:
+            self.template = _load_template()
+        _write(self.file, self.template[0])
+        if len(self.nav) > 0:
+            _write(self.file, self.nav)
+
+    def write_note(self, patch_note: PatchNote, result: Dict[str, Any]) -> None:
+        _write(self.file, result["html"])
+        self.search_index.add(result["search"])
+
+    def write_tail(self) -> None:
+        _write(self.file, self.template[1])
+        _write(self.file, _serialize_index(self.search_index))
+        _write(self.file, self.template[2])
+
+
+class JsonWriter(ExportWriter):
+    """The structure of every patch note (see structure.extract_structure) as JSON Lines"""
+
+    def write_note(self, patch_note: PatchNote, result: Dict[str, Any]) -> None:
+        _write(self.file, _json_record(patch_note, result))
+
+
+def _markdown_escape(text: str) -> str:
+    return RE_MARKDOWN_SPECIAL.sub(r"\\\1", text)
+
+
+def _join_blocks(blocks: List[str]) -> str:
+    return "\n\n".join(block for block in blocks if len(block) > 0) + "\n\n"
+
+
+class MarkdownWriter(ExportWriter):
+    """The patch notes as Markdown, built from the structure of the patch notes"""
+
+    def write_head(self) -> None:
+        _write(self.file, f"# {EXPORT_TITLE}\n\n")
+
+    def write_note(self, patch_note: PatchNote, result: Dict[str, Any]) -> None:
+        def _list(items: List[str]) -> str:
+            return "\n".join(f"- {_markdown_escape(item)}" for item in items)
+
+        data = result["data"]
+        blocks = [f"## {patch_note.time.isoformat()} {_markdown_escape(data['title'] or '')}".rstrip(),
+                  f"<{patch_note.url}>", _list(data["items"])]
+        for section in data["sections"]:
+            if section["title"] is not None:
+                blocks.append(f"### {_markdown_escape(section['title'])}")
+            blocks.append(_list(section["items"]))
+            for subsection in section["subsections"]:
+                blocks.extend([f"#### {_markdown_escape(subsection['title'])}", _list(subsection["items"])])
+        _write(self.file, _join_blocks(blocks))
+
+
+class TextWriter(ExportWriter):
+    """The patch notes as plain text, built from the structure of the patch notes"""
+
+    def write_note(self, patch_note: PatchNote, result: Dict[str, Any]) -> None:
+        def _list(items: List[str], indent: str = "") -> str:
+            return "\n".join(f"{indent}* {item}" for item in items)
+
+        data = result["data"]
+        title = f"{patch_note.time.isoformat()} {data['title'] or ''}".rstrip()
+        blocks = [f"{title}\n{'=' * len(title)}\n{patch_note.url}", _list(data["items"])]
+        for section in data["sections"]:
+            if section["title"] is not None:
+                blocks.append(f"{section['title']}\n{'-' * len(section['title'])}")
+            blocks.append(_list(section["items"]))
+            for subsection in section["subsections"]:
+                blocks.append(f"  {subsection['title']}\n{_list(subsection['items'], '  ')}".rstrip())
+        _write(self.file, _join_blocks(blocks) + "\n")
+
+
+class FeedWriter(ExportWriter):
+    """Atom feed of the newest patch notes, the content of every entry is the formatted html of the patch note"""
+
+    def __init__(self, path: str, link: str, limit: int = FEED_SIZE):
+        super().__init__(path)
+        self.link = link
+        self.limit = limit
+        self.entries = []  # type: List[str]
+        self.updated = None  # type: str | None
+
+    def write_note(self, patch_note: PatchNote, result: Dict[str, Any]) -> None:
+        updated = f"{patch_note.time.isoformat()}T00:00:00Z"
+        if self.updated is None:
+            self.updated = updated
+        title = f"{patch_note.time.isoformat()} {result['data']['title'] or ''}".rstrip()
+        self.entries.append("\n".join([
+            "<entry>",
+            f"<title>{html.escape(title)}</title>",
+            f"<id>{html.escape(patch_note.url)}</id>",
+            f'<link href="{html.escape(patch_note.url)}"/>',
+            f"<updated>{updated}</updated>",
+            f'<content type="html">{html.escape(result["html"])}</content>',
+            "</entry>",
+            ""
+        ]))
+
+    def write_tail(self) -> None:
+        updated = self.updated
+        if updated is None:
+            updated = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+        _write(self.file, "\n".join([
+            '<?xml version="1.0" encoding="utf-8"?>',
+            '<feed xmlns="http://www.w3.org/2005/Atom">',
+            f"<title>{html.escape(EXPORT_TITLE)}</title>",
+            f"<author><name>{html.escape(FEED_AUTHOR)}</name></author>",
+            f"<id>{html.escape(self.link)}</id>",
+            f'<link href="{html.escape(self.link)}"/>',
+            f"<updated>{updated}</updated>",
+            ""
+        ]))
+        for entry in self.entries:
+            _write(self.file, entry)
+        _write(self.file, "</feed>\n")
+
+
+def export_notes(patch_notes: List[PatchNote],
+                 writers: List[ExportWriter],
+                 fragment_cache: Optional[FragmentCache] = None,
+                 workers: int = 1) -> None:
+    """
+    Exports the patch notes into all given writers. Every patch note is formatted once (or taken from the fragment
+    cache) and the result is passed to all writers, newest patch note first. The content of patch notes that are not
+    loaded gets read from disk when it's needed. If all writers only need the newest patch notes (e.g. the feed), only
+    these get formatted.
+    """
+    ordered = sorted(patch_notes, key=lambda p: p.time, reverse=True)
+    limits = [writer.limit for writer in writers]
+    limited = len(limits) > 0 and None not in limits
+    if limited:
+        ordered = ordered[:max(limits)]
+    num_notes = len(ordered)
     logger.info("Inserting %s patch notes", num_notes)
-    for i, patch_note in enumerate(sorted(patch_notes, key=lambda p: p.time, reverse=True)):
-        div_patch_notes.append(get_html(patch_note))
-        if (i + 1) % 20 == 0:
-            logger.info("Inserted %s/%s", i + 1, num_notes)
-
-    logger.info("Generating final html")
-    html = template.prettify(encoding="utf-8")
-    logger.info("Saving to %s", path)
-    with open(path, "wb") as file:
-        file.write(html)
+    if workers > 1:
+        logger.info("Formatting patch notes with %s processes", workers)
+    used_keys = set()
+    results = _iter_fragments(ordered, fragment_cache, workers, used_keys)
+    try:
+        for writer in writers:
+            writer.open()
+        for i, (patch_note, result) in enumerate(zip(ordered, results)):
+            for writer in writers:
+                if writer.limit is None or i < writer.limit:
+                    writer.write_note(patch_note, result)
+            if (i + 1) % 20 == 0:
+                logger.info("Inserted %s/%s", i + 1, num_notes)
+        for writer in writers:
+            writer.finish()
+            logger.info("Saved to %s", writer.path)
+    finally:
+        results.close()
+        for writer in writers:
+            writer.close()
+    # The fragments of the patch notes that were left out are still needed
+    _finish_fragment_cache(fragment_cache, used_keys, prune=not limited)
+
+
+def export_html(patch_notes: List[PatchNote],
+                path: str,
+                fragment_cache: Optional[FragmentCache] = None,
+                workers: int = 1,
+                json_path: Optional[str] = None):
+    """
+    Exports the patch notes into a single html file (see export_notes). The search index is built from the formatted
+    patch notes and gets embedded after them.
+
+    If a json path is given, the structure of every patch note (see structure.extract_structure) is written into it as
+    JSON Lines, one line per patch note in the same order as the html.
+    """
+    writers = [HtmlWriter(path)]  # type: List[ExportWriter]
+    if json_path is not None:
+        writers.append(JsonWriter(json_path))
+    export_notes(patch_notes, writers, fragment_cache, workers)
+
+
+def _finish_fragment_cache(fragment_cache: Optional[FragmentCache], used_keys: Set[str], prune: bool = True) -> None:
+    if fragment_cache is not None:
+        logger.info("Reused %s cached patch notes, formatted %s patch notes",
+                    fragment_cache.hits, fragment_cache.misses)
+        if prune:
+            fragment_cache.prune(used_keys)
+
+
+def shard_patch_notes(patch_notes: List[PatchNote],
+                      shard_size: Optional[int] = None) -> List[Tuple[str, str, List[PatchNote]]]:
+    """
+    Splits the patch notes into one shard per year or, if a shard size is given, into shards with a fixed number of
+    patch notes. The shards with a fixed size are counted from the oldest patch note, so the older shards don't
+    change when new patch notes get released.
+
+    :return: The file name, the title and the patch notes of every shard, the newest shard and patch note first
+    """
+    ordered = sorted(patch_notes, key=lambda p: p.time)
+    shards = []  # type: List[Tuple[str, str, List[PatchNote]]]
+    if shard_size is None:
+        years = {}  # type: Dict[int, List[PatchNote]]
+        for patch_note in ordered:
+            years.setdefault(patch_note.time.year, []).append(patch_note)
+        for year, notes in years.items():
+            shards.append((f"patch_notes_{year}.html", str(year), notes))
+    else:
+        for i in range(0, len(ordered), shard_size):
+            notes = ordered[i:i + shard_size]
+            shards.append((f"patch_notes_{i // shard_size + 1}.html",
+                           f"{notes[0].time.isoformat()} - {notes[-1].time.isoformat()}", notes))
+    return [(name, title, notes[::-1]) for name, title, notes in reversed(shards)]
+
+
+def _note_hash(patch_note: PatchNote, stored_hashes: Dict[str, str]) -> str:
+    # Content that differs from the saved one (or was never saved) has to be hashed, otherwise the hash of the storage
+    # is used without loading the content
+    if not patch_note.content_loaded or patch_note.content_saved:
+        stored_hash = stored_hashes.get(patch_note.time.isoformat())
+        if stored_hash is not None:
+            return stored_hash
+    return content_hash(patch_note.content)
+
+
+def _shard_digest(patch_notes: List[PatchNote],
+                  template_digest: str,
+                  stored_hashes: Dict[str, str],
+                  fragment_cache: Optional[FragmentCache],
+                  used_keys: Set[str]) -> str:
+    # Changes whenever a patch note of the shard, the formatter or the template changes
+    digest = hashlib.sha256(f"{get_version()}\n{template_digest}\n".encode("utf-8"))
+    for patch_note in patch_notes:
+        note_hash = _note_hash(patch_note, stored_hashes)
+        digest.update(f"{patch_note.time.isoformat()}\n{patch_note.url}\n{note_hash}\n".encode("utf-8"))
+        if fragment_cache is not None:
+            # The fragments of unchanged shards must not get pruned
+            used_keys.add(fragment_cache.hash_key(patch_note.time.isoformat(), note_hash))
+    return digest.hexdigest()
+
+
+def _json_name(name: str) -> str:
+    return f"{os.path.splitext(name)[0]}.jsonl"
+
+
+def _shard_links(name: str, title: str, notes: List[List[str]]) -> str:
+    lines = ['<div class="patch-shard">',
+             f'<h2><a href="{html.escape(name)}">{html.escape(title)}</a></h2>',
+             "<ul>"]
+    for anchor, label in notes:
+        lines.append(f'<li><a href="{html.escape(name)}#{html.escape(anchor)}">{html.escape(label)}</a></li>')
+    lines.extend(["</ul>", "</div>", ""])
+    return "\n".join(lines)
+
+
+def export_sharded(patch_notes: List[PatchNote],
+                   path: str,
+                   fragment_cache: Optional[FragmentCache] = None,
+                   workers: int = 1,
+                   shard_size: Optional[int] = None,
+                   structured: bool = False) -> List[str]:
+    """
+    Exports the patch notes into one html page per shard (see shard_patch_notes) and an index page with links to all
+    patch notes and a search index over all pages. If structured is set, the structure of the patch notes of every
+    shard is written into a JSON Lines file next to the page (see export_html).
+
+    Only the shards whose patch notes changed (or after a change of the formatter or the template) are written again.
+    The digest, the links and the search index entries of every shard are saved in the manifest ``shards.json``, the
+    index page is built from it without formatting the unchanged shards.
+
+    :return: The paths of all written files
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest_path = f"{path}/{SHARD_MANIFEST}"
+    manifest = {}  # type: Dict[str, Dict[str, Any]]
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+    with open(TEMPLATE_PATH, "rb") as file:
+        template_digest = hashlib.sha256(file.read()).hexdigest()
+
+    shards = shard_patch_notes(patch_notes, shard_size)
+    stored_hashes = {}  # type: Dict[str, str]
+    if any(not p.content_loaded or p.content_saved for p in patch_notes):
+        stored_hashes = get_storage().content_hashes()
+    used_keys = set()
+    new_manifest = {}  # type: Dict[str, Dict[str, Any]]
+    changed = []
+    for name, title, notes in shards:
+        digest = _shard_digest(notes, template_digest, stored_hashes, fragment_cache, used_keys)
+        entry = manifest.get(name)
+        if entry is not None and entry["digest"] == digest and os.path.exists(f"{path}/{name}") \
+                and (not structured or os.path.exists(f"{path}/{_json_name(name)}")):
+            new_manifest[name] = entry
+        else:
+            changed.append((name, title, notes, digest))
+    logger.info("Exporting %s patch notes into %s shards, %s shards changed",
+                len(patch_notes), len(shards), len(changed))
+
+    template = _load_template()
+    head, middle, tail = template
+    written = []
+    results = _iter_fragments([p for _, _, notes, _ in changed for p in notes], fragment_cache, workers, used_keys)
+    try:
+        for name, title, notes, digest in changed:
+            html_writer = HtmlWriter(f"{path}/{name}", template,
+                                     nav=f'<p class="shard-nav"><a href="{INDEX_PAGE}">All patch notes</a></p>\n')
+            writers = [html_writer]  # type: List[ExportWriter]
+            if structured:
+                writers.append(JsonWriter(f"{path}/{_json_name(name)}"))
+            links = []
+            try:
+                for writer in writers:
+                    writer.open()
+                for patch_note in notes:
+                    result = next(results)
+                    for writer in writers:
+                        writer.write_note(patch_note, result)
+                    links.append(result["search"]["docs"][0])
+                for writer in writers:
+                    writer.finish()
+            finally:
+                for writer in writers:
+                    writer.close()
+            new_manifest[name] = {"digest": digest, "title": title, "notes": links,
+                                  "search": html_writer.search_index.to_entries()}
+            written.extend(writer.path for writer in writers)
+            logger.info("Saved shard %s with %s patch notes", name, len(notes))
+    finally:
+        results.close()
+
+    for name in manifest.keys() - new_manifest.keys():
+        if os.path.exists(f"{path}/{name}"):
+            logger.info("Removing outdated shard %s", name)
+            os.remove(f"{path}/{name}")
+        if os.path.exists(f"{path}/{_json_name(name)}"):
+            os.remove(f"{path}/{_json_name(name)}")
+
+    search_index = search.SearchIndexBuilder()
+    tmp_path = f"{path}/{INDEX_PAGE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        _write(file, head)
+        for name, title, _ in shards:
+            entry = new_manifest[name]
+            _write(file, _shard_links(name, title, entry["notes"]))
+            search_index.add(entry["search"], page=name)
+        _write(file, middle)
+        _write(file, _serialize_index(search_index))
+        _write(file, tail)
+    os.replace(tmp_path, f"{path}/{INDEX_PAGE}")
+    written.append(f"{path}/{INDEX_PAGE}")
+
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(new_manifest, file, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+    logger.info("Saved index page to %s", f"{path}/{INDEX_PAGE}")
+    _finish_fragment_cache(fragment_cache, used_keys)
+    return written
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Optional, Set, Dict, Any
+
+from ee_patch_notes.metrics import registry as metrics
+from ee_patch_notes.storage import content_hash
+
+logger = logging.getLogger("ee.cache")
+
+
+class FragmentCache:
+    """
+    Cache for the formatting results (the html and additional data like the search index entries) of single patch
+    notes.
+
+    The entries are keyed by the hash of the raw patch note content (the hash the storage saves) and the formatter
+    version, a patch note only has to be formatted again if its content or the formatter changed. The key can be
+    computed from the saved hash without loading the content.
+    """
+
+    def __init__(self, path: str, version: str):
+        self.path = path
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, name: str, content: str) -> str:
+        return self.hash_key(name, content_hash(content))
+
+    def hash_key(self, name: str, patch_note_hash: str) -> str:
+        """Returns the key for a patch note with the given content hash (see storage.content_hash)"""
+        return hashlib.sha256(f"{self.version}\n{name}\n{patch_note_hash}".encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return f"{self.path}/{key}.json"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._entry_path(key), "r", encoding="utf-8") as file:
+                entry = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.misses += 1
+            metrics.inc("fragment_cache_misses")
+            return None
+        self.hits += 1
+        metrics.inc("fragment_cache_hits")
+        return entry
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        tmp_path = f"{self._entry_path(key)}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(entry, file, ensure_ascii=False)
+        os.replace(tmp_path, self._entry_path(key))
+
+    def prune(self, keys: Set[str]) -> None:
+        """Deletes all entries that are not in the given set of keys"""
+        removed = 0
+        for file_name in os.listdir(self.path):
+            key, ext = os.path.splitext(file_name)
+            if ext != ".json" or key not in keys:
+                os.remove(f"{self.path}/{file_name}")
+                removed += 1
+        if removed > 0:
+            logger.info("Removed %s outdated fragments from %s", removed, self.path)
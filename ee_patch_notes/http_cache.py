@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Dict, Optional, Any
+
+from requests import Response
+
+logger = logging.getLogger("ee.cache")
+
+
+class HttpCache:
+    """
+    Persistent cache for conditional http requests.
+
+    For every url the last response body gets saved together with its validators (``ETag`` and ``Last-Modified``).
+    These are sent with the next request for the url, a ``304 Not Modified`` response gets answered with the cached
+    body. Callers can additionally attach already parsed results to an entry, they get dropped as soon as the server
+    delivers a new body.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = f"{path}/index.json"
+        self._lock = threading.Lock()
+        self._entries = {}  # type: Dict[str, Dict[str, Any]]
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                self._entries = json.load(file)
+
+    def _body_path(self, url: str) -> str:
+        return f"{self.path}/{hashlib.sha1(url.encode('utf-8')).hexdigest()}.html"
+
+    def _save_index(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self._entries, file)
+        os.replace(tmp_path, self.index_path)
+
+    def request_headers(self, url: str) -> Dict[str, str]:
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is None or not os.path.exists(self._body_path(url)):
+            return {}
+        headers = {}
+        if entry.get("etag") is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified") is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, url: str, response: Response) -> None:
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._body_path(url), "wb") as file:
+            file.write(response.content)
+        with self._lock:
+            self._entries[url] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "meta": {}
+            }
+            self._save_index()
+
+    def load(self, url: str, response: Response) -> Response:
+        """Fills a 304 response with the cached body and marks it with ``from_cache``"""
+        with open(self._body_path(url), "rb") as file:
+            response._content = file.read()
+        response.status_code = 200
+        response.from_cache = True
+        logger.debug("Page %s was not modified, using cached version", url)
+        return response
+
+    def get_meta(self, url: str, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            return entry["meta"].get(key)
+
+    def set_meta(self, url: str, key: str, value: Any) -> None:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return
+            entry["meta"][key] = value
+            self._save_index()
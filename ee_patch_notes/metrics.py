@@ -0,0 +1,104 @@
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, Any, Iterator
+
+PROMETHEUS_PREFIX = "ee_patch_notes"
+
+
+class Metrics:
+    """
+    Thread-safe collection of counters and timers of a run.
+
+    Counters are plain sums (e.g. the downloaded bytes), gauges hold the last set value and timers collect the number
+    of observations and the total, minimum and maximum duration in seconds (e.g. the latency of every request).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}  # type: Dict[str, float]
+        self.gauges = {}  # type: Dict[str, float]
+        self.timers = {}  # type: Dict[str, Dict[str, float]]
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float) -> None:
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = {"count": 1, "total": seconds, "min": seconds, "max": seconds}
+                return
+            timer["count"] += 1
+            timer["total"] += seconds
+            timer["min"] = min(timer["min"], seconds)
+            timer["max"] = max(timer["max"], seconds)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timers.clear()
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timers": {name: {**timer, "mean": timer["total"] / timer["count"]}
+                           for name, timer in self.timers.items()}
+            }
+
+    def write_json(self, path: str, meta: Dict[str, Any]) -> None:
+        _write_atomic(path, json.dumps({"meta": meta, **self.to_dict()}, indent=2))
+
+    def write_prometheus(self, path: str) -> None:
+        """Writes the metrics in the text format of the Prometheus node exporter textfile collector"""
+        data = self.to_dict()
+        lines = []
+        for name, value in sorted(data["counters"].items()):
+            metric = f"{PROMETHEUS_PREFIX}_{_metric_name(name)}_total"
+            lines.extend([f"# TYPE {metric} counter", f"{metric} {value}"])
+        for name, value in sorted(data["gauges"].items()):
+            metric = f"{PROMETHEUS_PREFIX}_{_metric_name(name)}"
+            lines.extend([f"# TYPE {metric} gauge", f"{metric} {value}"])
+        for name, timer in sorted(data["timers"].items()):
+            metric = f"{PROMETHEUS_PREFIX}_{_metric_name(name)}_seconds"
+            lines.extend([f"# TYPE {metric} summary",
+                          f"{metric}_count {timer['count']}",
+                          f"{metric}_sum {timer['total']}",
+                          f"# TYPE {metric}_max gauge",
+                          f"{metric}_max {timer['max']}"])
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _write_atomic(path: str, text: str) -> None:
+    # The textfile collector must never see a partially written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+# The metrics of the current run, shared by all modules
+registry = Metrics()
@@ -0,0 +1,59 @@
+import logging
+from typing import Optional, Union
+
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.builder import builder_registry
+
+logger = logging.getLogger("ee.parser")
+
+try:
+    # noinspection PyUnresolvedReferences
+    import lxml  # noqa: F401
+    DEFAULT_PARSER = "lxml"
+except ImportError:
+    DEFAULT_PARSER = "html.parser"
+
+PARSERS = ["lxml", "html.parser", "html5lib"]
+# The parser for the downloaded pages, the extracted patch notes are saved as serialized by this parser, so it stays
+# html.parser unless another parser is selected (the saved patch notes would differ from the downloaded ones)
+HTML_PARSER = "html.parser"
+# The parser for formatting the patch notes, the formatting rules were written for the tree structure that
+# html.parser creates, other parsers might produce slightly different results. The parsed patch notes are only passed
+# to the formatter if the downloaded pages get parsed with the same parser (see scraper.KEEP_PARSED).
+FORMATTER_PARSER = "html.parser"
+
+# Only the relevant parts of the downloaded pages get parsed
+STRAINER_PAGER = SoupStrainer("div", class_="pager")
+STRAINER_LIST = SoupStrainer("ul", class_="newList")
+STRAINER_DETAIL = SoupStrainer("div", class_="newDetail")
+
+
+def is_available(name: str) -> bool:
+    """Whether bs4 can use the parser, lxml and html5lib are optional dependencies"""
+    return builder_registry.lookup(name) is not None
+
+
+def set_parser(name: str, formatter: bool = False) -> None:
+    """Selects the parser backend, ``auto`` selects lxml if it is installed"""
+    global HTML_PARSER, FORMATTER_PARSER
+    if name == "auto":
+        name = DEFAULT_PARSER
+    if name not in PARSERS:
+        raise ValueError(f"Unknown parser {name}, must be one of {', '.join(PARSERS)}")
+    if not is_available(name):
+        raise ValueError(f"The parser {name} is not installed (pip install {name})")
+    if formatter:
+        FORMATTER_PARSER = name
+    else:
+        HTML_PARSER = name
+    logger.info("Using parser %s for %s", name, "formatting" if formatter else "downloaded pages")
+
+
+def parse_page(markup: Union[str, bytes], parse_only: Optional[SoupStrainer] = None) -> BeautifulSoup:
+    return BeautifulSoup(markup, HTML_PARSER, parse_only=parse_only)
+
+
+def parse_patch_note(markup: str) -> BeautifulSoup:
+    # lxml and html5lib would wrap the patch note inside <html><body>, the strainer drops these tags
+    parse_only = STRAINER_DETAIL if FORMATTER_PARSER != "html.parser" else None
+    return BeautifulSoup(markup, FORMATTER_PARSER, parse_only=parse_only)
@@ -3,14 +3,23 @@ import logging
 import os.path
 import random
 import re
-from datetime import datetime, date
-from time import sleep
-from typing import Optional, List, Dict
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
+from time import sleep, monotonic
+from typing import Optional, List, Dict, Set
 
 import requests
-from bs4 import BeautifulSoup, Tag
+from bs4 import Tag, BeautifulSoup
 from requests import Response
 
+from ee_patch_notes import parser
+from ee_patch_notes.archive import ResponseArchive
+from ee_patch_notes.metrics import registry as metrics
+from ee_patch_notes.http_cache import HttpCache
+from ee_patch_notes.storage import Storage, FileStorage, content_hash
+
 logger = logging.getLogger("ee.web")
 
 HEADERS = {
@@ -18,10 +27,26 @@ HEADERS = {
 }
 RATE_LIMIT_SECONDS = 1
 RATE_LIMIT_RAND_FAC = 1
-last_request = None  # type: datetime | None
+REQUEST_TIMEOUT = 30
+# Requests that failed with one of these status codes (or a timeout) get retried after a jittered exponential backoff
+RETRY_STATUS = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1
+MAX_RETRY_AFTER = 600
+# Serve all pages from the response archive instead of sending requests
+REPLAY = False
+# Keep the parsed content of downloaded patch notes for the formatter (for the modes that download and export), only
+# possible if the downloaded pages and the patch notes get parsed with the same parser
+KEEP_PARSED = False
 DOWNLOAD_PATH = "data/patch_notes"
-CACHE_PATH = f"{DOWNLOAD_PATH}/cache.json"
+CACHE_PATH = f"{DOWNLOAD_PATH}/cache.jsonl"
+# The session of the main thread, requests doesn't guarantee that a Session is thread-safe, so the worker threads of
+# the concurrent downloads get their own session (see get_session)
 session = requests.Session()
+_thread_local = threading.local()
+http_cache = None  # type: HttpCache | None
+archive = None  # type: ResponseArchive | None
+storage = None  # type: Storage | None
 
 
 def mk_dirs():
@@ -34,6 +59,10 @@ class WebScrapeException(Exception):
 
 
 class PatchNote:
+    """
+    A patch note with its url and release date. The content gets loaded lazily from the storage when it is accessed
+    the first time, it can be released again via ``release_content``.
+    """
     date_pattern = re.compile(r"updata/(\d+)/")
 
     def __init__(self, url: str, time: Optional[date] = None):
@@ -46,10 +75,40 @@ class PatchNote:
             else:
                 raise WebScrapeException("Invalid url " + url)
         self.time = time
-        self.content = None  # type: str | None
+        self._content = None  # type: str | None
+        # Whether the loaded content is the one in the storage, saved content can be released and loaded again
+        self.content_saved = False
+        # The parsed content of a downloaded patch note, the formatter uses it (once) instead of parsing the content
+        self.parsed = None  # type: BeautifulSoup | None
         if self.time is None:
             self.extract_date_from_url()
 
+    @property
+    def content(self) -> Optional[str]:
+        """The content of the patch note, None if it was neither downloaded nor saved before"""
+        if self._content is None:
+            try:
+                self._content = get_storage().load_content(self.time.isoformat())
+            except KeyError:
+                return None
+            self.content_saved = True
+        return self._content
+
+    @content.setter
+    def content(self, content: Optional[str]) -> None:
+        self._content = content
+        self.content_saved = False
+        self.parsed = None
+
+    @property
+    def content_loaded(self) -> bool:
+        return self._content is not None
+
+    def release_content(self) -> None:
+        self._content = None
+        self.content_saved = False
+        self.parsed = None
+
     def extract_date_from_url(self) -> None:
         match = PatchNote.date_pattern.search(self.url)
         if match is None:
@@ -59,11 +118,11 @@ class PatchNote:
         self.time = date(year=int(raw[:4]), month=int(raw[4:6]), day=int(raw[6:]))
 
     def save_content(self, file_path: str) -> None:
-        if self.content is None:
+        if self._content is None:
             raise WebScrapeException("Can't save patch notes %s (%s) to file %s as there is no content loaded",
                                      self.time, self.url, file_path)
         with open(file_path, "w", encoding="utf-8") as file:
-            file.write(self.content)
+            file.write(self._content)
 
     def to_meta_dict(self) -> Dict[str, Optional[str]]:
         return {
@@ -82,79 +141,267 @@ class PatchNote:
         )
 
 
+def get_storage() -> Storage:
+    """Returns the configured storage, by default the patch notes are saved as files in DOWNLOAD_PATH"""
+    if storage is not None:
+        return storage
+    return FileStorage(DOWNLOAD_PATH, CACHE_PATH)
+
+
 def save_patch_note_cache(patch_notes: List[PatchNote]) -> None:
-    result = {}
-    for patch_note in patch_notes:
-        result[patch_note.time.isoformat()] = patch_note.to_meta_dict()
-    with open(CACHE_PATH, "w", encoding="utf-8") as file:
-        json.dump(result, file)
-    logger.info("Dumped patch note metadata to %s", CACHE_PATH)
-
-
-def load_patch_notes_from_cache(file_path: str = CACHE_PATH) -> List[PatchNote]:
-    if not os.path.exists(file_path):
-        logger.warning("Patch note cache file not found: %s", file_path)
-        return []
-    with open(file_path, "r", encoding="utf-8") as file:
-        raw = json.load(file)
-    patch_notes = []
-    for key, raw_p in raw.items():
-        patch_notes.append(PatchNote.from_meta_dict(raw_p))
-    return patch_notes
+    get_storage().save_meta([patch_note.to_meta_dict() for patch_note in patch_notes])
+
+
+def load_patch_notes_from_cache(file_path: Optional[str] = None) -> List[PatchNote]:
+    source = get_storage() if file_path is None else FileStorage(DOWNLOAD_PATH, file_path)
+    return [PatchNote.from_meta_dict(raw) for raw in source.load_meta()]
 
 
 def append_patch_note_cache(patch_notes: List[PatchNote]) -> None:
-    if not os.path.exists(CACHE_PATH):
-        logger.warning("Patch note cache file not found: %s", CACHE_PATH)
-        raw = {}
-    else:
-        with open(CACHE_PATH, "r", encoding="utf-8") as file:
-            raw = json.load(file)
-    for patch_note in patch_notes:
-        raw[patch_note.time.isoformat()] = patch_note.to_meta_dict()
-    with open(CACHE_PATH, "w", encoding="utf-8") as file:
-        json.dump(raw, file)
-    logger.info("Dumped patch note metadata to %s", CACHE_PATH)
+    get_storage().append_meta([patch_note.to_meta_dict() for patch_note in patch_notes])
 
 
 def load_patch_note_content(patch_note: PatchNote):
-    file_path = f"{DOWNLOAD_PATH}/patch_notes_{patch_note.time.isoformat()}.html"
-    with open(file_path, "r", encoding="utf-8") as file:
-        patch_note.content = file.read()
+    patch_note.content = get_storage().load_content(patch_note.time.isoformat())
+    patch_note.content_saved = True
 
 
 def load_patch_notes_content(patch_notes: List[PatchNote]):
+    contents = get_storage().load_contents(p.time.isoformat() for p in patch_notes)
     for patch_note in patch_notes:
-        load_patch_note_content(patch_note)
+        patch_note.content = contents[patch_note.time.isoformat()]
+        patch_note.content_saved = True
+
+
+def get_session() -> requests.Session:
+    """Returns the session of the current thread, every thread keeps its own connection pool"""
+    if threading.current_thread() is threading.main_thread():
+        return session
+    thread_session = getattr(_thread_local, "session", None)
+    if thread_session is None:
+        thread_session = _thread_local.session = requests.Session()
+    return thread_session
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket shared by all threads that send requests.
+
+    A new token becomes available every ``delay + rand_fac * random.random()`` seconds, at most ``burst`` tokens can
+    be saved up. If ``delay`` or ``rand_fac`` are None, the module settings ``RATE_LIMIT_SECONDS`` and
+    ``RATE_LIMIT_RAND_FAC`` are used (they may get changed after the limiter was created).
+    """
+
+    def __init__(self, delay: Optional[float] = None, rand_fac: Optional[float] = None, burst: int = 1):
+        self.delay = delay
+        self.rand_fac = rand_fac
+        self.burst = burst
+        self._next_slot = None  # type: float | None
+        self._lock = threading.Lock()
+
+    def _base_delay(self) -> float:
+        return RATE_LIMIT_SECONDS if self.delay is None else self.delay
+
+    def _interval(self) -> float:
+        rand_fac = RATE_LIMIT_RAND_FAC if self.rand_fac is None else self.rand_fac
+        return self._base_delay() + rand_fac * random.random()
+
+    def reserve(self) -> float:
+        """Reserves the next free token and returns the number of seconds to wait until it may be used"""
+        with self._lock:
+            now = monotonic()
+            if self._next_slot is None:
+                slot = now
+            else:
+                slot = max(self._next_slot, now - (self.burst - 1) * self._base_delay())
+            self._next_slot = slot + self._interval()
+        return max(0.0, slot - now)
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            metrics.inc("rate_limit_sleep_seconds", delay)
+            sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """Delays all following requests by at least the given time (e.g. because of a Retry-After header)"""
+        with self._lock:
+            resume = monotonic() + seconds
+            self._next_slot = resume if self._next_slot is None else max(self._next_slot, resume)
+
+    def report(self, latency: float, healthy: bool) -> None:
+        """Feedback about a finished request, the static limiter ignores it"""
+        pass
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """
+    Rate limiter that adapts the delay to the server (AIMD).
+
+    After every healthy response the delay decreases by ``step`` seconds down to ``min_delay``. Errors (429, 5xx,
+    timeouts) and rising response times (the moving average of the latency exceeds ``slow_factor`` times the lowest
+    average seen so far) multiply the delay with ``backoff`` up to ``max_delay``. Every interval gets a random
+    extension of up to ``jitter`` times the delay.
+    """
+
+    def __init__(self,
+                 min_delay: float,
+                 max_delay: float = 60,
+                 start_delay: Optional[float] = None,
+                 step: float = 0.1,
+                 backoff: float = 2,
+                 slow_factor: float = 2,
+                 jitter: float = 0.25,
+                 burst: int = 1):
+        super().__init__(burst=burst)
+        self.min_delay = min_delay
+        self.max_delay = max(max_delay, min_delay)
+        self.current_delay = min(max(RATE_LIMIT_SECONDS if start_delay is None else start_delay, min_delay),
+                                 self.max_delay)
+        self.step = step
+        self.backoff = backoff
+        self.slow_factor = slow_factor
+        self.jitter = jitter
+        self._latency = None  # type: float | None
+        self._lowest_latency = None  # type: float | None
+        self._samples = 0
+
+    def _base_delay(self) -> float:
+        return self.current_delay
+
+    def _interval(self) -> float:
+        return self.current_delay * (1 + self.jitter * random.random())
+
+    def report(self, latency: float, healthy: bool) -> None:
+        with self._lock:
+            self._samples += 1
+            self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+            if self._samples >= 3:
+                self._lowest_latency = self._latency if self._lowest_latency is None else min(self._lowest_latency,
+                                                                                              self._latency)
+            slow = self._lowest_latency is not None and self._latency > self.slow_factor * self._lowest_latency
+            old_delay = self.current_delay
+            if healthy and not slow:
+                self.current_delay = max(self.min_delay, self.current_delay - self.step)
+            else:
+                self.current_delay = min(self.max_delay, self.current_delay * self.backoff)
+        if self.current_delay != old_delay:
+            logger.debug("Changed the request delay from %.2f s to %.2f s (latency %.2f s, %s)", old_delay,
+                         self.current_delay, latency, "healthy" if healthy else "failed")
+
+
+limiter = RateLimiter()
 
 
 def rate_limit():
-    global last_request
-    if last_request is None:
-        last_request = datetime.now()
-        return
-    diff = (datetime.now() - last_request).total_seconds()
-    if diff < RATE_LIMIT_SECONDS:
-        delay = RATE_LIMIT_SECONDS + RATE_LIMIT_RAND_FAC * random.random() - diff
-        sleep(delay)
-    last_request = datetime.now()
+    limiter.acquire()
 
 
-def fetch_page(url: str) -> Response:
-    rate_limit()
-    logger.info("Fetching page %s", url)
-    return session.get(url, headers=HEADERS)
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(0.0, seconds), MAX_RETRY_AFTER)
+
+
+def _get_with_retries(url: str, headers: Dict[str, str]) -> Response:
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limit()
+        logger.info("Fetching page %s", url)
+        start = monotonic()
+        metrics.inc("requests")
+        try:
+            response = get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        except (requests.Timeout, requests.ConnectionError) as e:
+            limiter.report(monotonic() - start, False)
+            metrics.inc("request_errors")
+            if attempt >= MAX_RETRIES:
+                raise WebScrapeException(f"Failed to fetch {url}: {e}") from e
+            logger.warning("Failed to fetch %s (%s), retrying", url, e)
+            retry_after = None
+        else:
+            latency = monotonic() - start
+            healthy = response.status_code not in RETRY_STATUS
+            limiter.report(latency, healthy)
+            metrics.observe("fetch", latency)
+            metrics.inc("bytes_downloaded", len(response.content))
+            if healthy:
+                return response
+            metrics.inc("request_errors")
+            if attempt >= MAX_RETRIES:
+                raise WebScrapeException(f"Failed to fetch {url}: status {response.status_code}")
+            retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+            logger.warning("Failed to fetch %s (status %s), retrying", url, response.status_code)
+        metrics.inc("retries")
+        if retry_after is not None:
+            limiter.pause(retry_after)
+        else:
+            # Exponential backoff with full jitter
+            sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+
+
+def fetch_page(url: str, use_cache=False) -> Response:
+    if REPLAY:
+        return _replay_page(url)
+    use_cache = use_cache and http_cache is not None
+    headers = HEADERS
+    if use_cache:
+        headers = {**HEADERS, **http_cache.request_headers(url)}
+    response = _get_with_retries(url, headers)
+    if use_cache and response.status_code == 304:
+        metrics.inc("not_modified")
+        response = http_cache.load(url, response)
+        # The archive gets the cached body, otherwise the page could not be replayed
+        if archive is not None:
+            archive.record(url, response, not_modified=True)
+        return response
+    if archive is not None:
+        archive.record(url, response)
+    if use_cache and response.status_code == 200:
+        http_cache.store(url, response)
+    return response
+
+
+def _replay_page(url: str) -> Response:
+    response = archive.load(url) if archive is not None else None
+    if response is None:
+        raise WebScrapeException(f"Page {url} is not archived")
+    logger.debug("Replaying page %s", url)
+    metrics.inc("replayed_responses")
+    return response
+
+
+def _get_cached_result(url: str, page: Response, key: str):
+    # Returns the result of an earlier parsing of the page if the server responded with 304 Not Modified
+    if http_cache is None or not getattr(page, "from_cache", False):
+        return None
+    return http_cache.get_meta(url, key)
+
+
+def _set_cached_result(url: str, key: str, value) -> None:
+    if http_cache is not None:
+        http_cache.set_meta(url, key, value)
 
 
 def load_page_range(home_url: str) -> int:
-    page = fetch_page(home_url)
+    page = fetch_page(home_url, use_cache=True)
+    last_page = _get_cached_result(home_url, page, "last_page")
+    if last_page is not None:
+        logger.info("Page %s was not modified, last patch notes page has id %s", home_url, last_page)
+        return last_page
 
     # Find the div for the pagination
-    soup = BeautifulSoup(page.content, "html.parser")
-    try:
-        data_pager = soup.find("div", class_="wrap").find("div", "pageBox").find("div", "pager")
-    except TypeError as e:
-        raise WebScrapeException("Failed to process news page format") from e
+    with metrics.timer("parse_pager"):
+        soup = parser.parse_page(page.content, parse_only=parser.STRAINER_PAGER)
+    data_pager = soup.find("div", "pager")
+    if data_pager is None:
+        raise WebScrapeException("Failed to process news page format")
 
     # Find the url from the link to the "Last" page
     data_controllers = data_pager.find_all("a", class_="next")
@@ -176,18 +423,28 @@ def load_page_range(home_url: str) -> int:
         raise WebScrapeException("Invalid url pattern")
     last_page = int(match.group(1))
     logger.info("Last patch notes page has id %s", last_page)
+    _set_cached_result(home_url, "last_page", last_page)
     return last_page
 
 
 def extract_patch_notes_urls(url: str) -> List[PatchNote]:
-    page = fetch_page(url)
+    page = fetch_page(url, use_cache=True)
+    cached = _get_cached_result(url, page, "patch_notes")
+    if cached is not None:
+        logger.info("Page %s was not modified, using %s cached patch note urls", url, len(cached))
+        return [PatchNote.from_meta_dict(raw) for raw in cached]
+    patch_urls = parse_patch_notes_list(page.content, url)
+    _set_cached_result(url, "patch_notes", [p.to_meta_dict() for p in patch_urls])
+    return patch_urls
 
-    soup = BeautifulSoup(page.content, "html.parser")
-    try:
-        data_list = soup.find("div", class_="wrap").find("ul", "newList")
-    except TypeError as e:
+
+def parse_patch_notes_list(raw: bytes, url: str) -> List[PatchNote]:
+    with metrics.timer("parse_list"):
+        soup = parser.parse_page(raw, parse_only=parser.STRAINER_LIST)
+    data_list = soup.find("ul", "newList")
+    if data_list is None:
         logger.error("Failed to parse patch notes list from page %s", url)
-        raise WebScrapeException("Failed parse patch notes list") from e
+        raise WebScrapeException("Failed parse patch notes list")
     patch_urls = []  # type: List[PatchNote]
     logger.info("Searching patch notes urls")
     for item in data_list.find_all("li", class_="item"):
@@ -210,34 +467,146 @@ def extract_patch_notes_urls(url: str) -> List[PatchNote]:
     return patch_urls
 
 
-def find_all_patch_notes_urls(base_url: str, max_index: int, min_index: int = 1, cache=True) -> List[PatchNote]:
+class LoadCheckpoint:
+    """
+    Journal of the progress of load_all (one json record per line), so an interrupted run can be resumed: the patch
+    notes found on every overview page and the key of every processed patch note are appended to it. The first record
+    contains the url of the overview pages, a journal of a different url is not resumed.
+
+    If new patch notes get released before the run is resumed, older patch notes move to the following overview pages.
+    These pages were not loaded yet, so no patch note gets lost (the new ones are found by load_new).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pages = {}  # type: Dict[int, List[Dict[str, Optional[str]]]]
+        self.done = set()  # type: Set[str]
+        self._file = None
+
+    def open(self, base_url: str, resume: bool) -> None:
+        if resume and os.path.exists(self.path):
+            self._read(base_url)
+        if len(self.pages) == 0 and len(self.done) == 0:
+            self._file = open(self.path, "w", encoding="utf-8")
+            self._append({"url": base_url})
+            return
+        logger.info("Resuming load_all with %s loaded overview pages and %s processed patch notes",
+                    len(self.pages), len(self.done))
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _read(self, base_url: str) -> None:
+        with open(self.path, "r", encoding="utf-8") as file:
+            for i, line in enumerate(file):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    if i == 0:
+                        # Without the url it is unknown which overview pages the checkpoint belongs to
+                        logger.warning("Checkpoint %s is unreadable, starting from the beginning", self.path)
+                        return
+                    # Only the last record can be incomplete
+                    continue
+                if i == 0 and record.get("url") != base_url:
+                    logger.warning("Checkpoint %s belongs to %s, starting from the beginning", self.path,
+                                   record.get("url"))
+                    return
+                if "page" in record:
+                    self.pages[record["page"]] = record["notes"]
+                elif "done" in record:
+                    self.done.add(record["done"])
+
+    def _append(self, record: Dict) -> None:
+        # The last line stays complete as long as the line is written at once
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def add_page(self, index: int, patch_notes: List[PatchNote]) -> None:
+        notes = [p.to_meta_dict() for p in patch_notes]
+        self.pages[index] = notes
+        self._append({"page": index, "notes": notes})
+
+    def add_done(self, patch_note: PatchNote) -> None:
+        self.done.add(patch_note.time.isoformat())
+        self._append({"done": patch_note.time.isoformat()})
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def finish(self) -> None:
+        """Removes the checkpoint after a completed run"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _overview_url(base_url: str, i: int) -> str:
+    return base_url.format(index="" if i == 1 else f"_{i}")
+
+
+def find_all_patch_notes_urls(base_url: str, max_index: int, min_index: int = 1, cache=True,
+                              checkpoint: Optional[LoadCheckpoint] = None) -> List[PatchNote]:
     patch_notes = []
     for i in range(min_index, max_index + 1):
+        if checkpoint is not None and i in checkpoint.pages:
+            patch_notes.extend(PatchNote.from_meta_dict(raw) for raw in checkpoint.pages[i])
+            continue
         logger.info("Loading patch note urls %s/%s", i, max_index)
-        index = f"_{i}"
-        if i == 1:
-            index = ""
-        new_notes = extract_patch_notes_urls(base_url.format(index=index))
+        new_notes = extract_patch_notes_urls(_overview_url(base_url, i))
+        if checkpoint is not None:
+            checkpoint.add_page(i, new_notes)
         patch_notes.extend(new_notes)
+    if checkpoint is not None:
+        # Patch notes that moved to the next page between an interruption and the resumption are found twice
+        unique = {}  # type: Dict[date, PatchNote]
+        for patch_note in patch_notes:
+            unique.setdefault(patch_note.time, patch_note)
+        patch_notes = list(unique.values())
     logger.info("Loaded a total of %s patch note urls", len(patch_notes))
     if cache:
         save_patch_note_cache(patch_notes)
     return patch_notes
 
 
-def download_patch_note(patch_note: PatchNote, save_path: str) -> None:
+def download_patch_note(patch_note: PatchNote, saved_hash: Optional[str] = None) -> bool:
+    """Downloads and saves the patch note, returns False if it was not saved because its content has the saved hash"""
     page = fetch_page(patch_note.url)
 
     # with open(save_path, "w", encoding="utf-8") as file:
     #     file.write(page.content.decode(encoding="utf-8"))
 
-    soup = BeautifulSoup(page.content, "html.parser")
+    extract_patch_note(patch_note, page.content)
+    return _save_changed_patch_note(patch_note, saved_hash)
 
-    try:
-        data_patch_notes = soup.find("div", class_="wrap").find("div", "newDetail")
-    except TypeError as e:
+
+def _save_changed_patch_note(patch_note: PatchNote, saved_hash: Optional[str]) -> bool:
+    if saved_hash is not None and content_hash(patch_note.content) == saved_hash:
+        logger.debug("Patch notes %s did not change", patch_note.time)
+        metrics.inc("patch_notes_unchanged")
+        patch_note.content_saved = True
+        return False
+    save_patch_note(patch_note)
+    return True
+
+
+def save_patch_note(patch_note: PatchNote) -> None:
+    if not patch_note.content_loaded:
+        raise WebScrapeException(f"Can't save patch notes {patch_note.time} ({patch_note.url}) as there is no "
+                                 f"content loaded")
+    with metrics.timer("save_patch_note"):
+        get_storage().save_content(patch_note.time.isoformat(), patch_note.content)
+    patch_note.content_saved = True
+    logger.debug("Saved patch notes %s", patch_note.url)
+
+
+def extract_patch_note(patch_note: PatchNote, raw: bytes) -> None:
+    with metrics.timer("parse_patch_note"):
+        soup = parser.parse_page(raw, parse_only=parser.STRAINER_DETAIL)
+    data_patch_notes = soup.find("div", "newDetail")
+    if data_patch_notes is None:
         logger.error("Failed to parse patch notes %s", patch_note.url)
-        raise WebScrapeException("Failed parse patch notes") from e
+        raise WebScrapeException("Failed parse patch notes")
 
     data_content = data_patch_notes.find("div", class_="artCon")
     data_title = data_patch_notes.find("div", class_="title")
@@ -249,39 +618,194 @@ def download_patch_note(patch_note: PatchNote, save_path: str) -> None:
         raise WebScrapeException("Failed parse patch note title")
 
     patch_note.content = data_patch_notes.decode()
-    patch_note.save_content(save_path)
-    logger.debug("Saved patch notes %s to %s", patch_note.url, save_path)
-
-
-def download_all_patch_notes(patch_notes: List[PatchNote], skip_existing=True) -> None:
+    if KEEP_PARSED and parser.HTML_PARSER == parser.FORMATTER_PARSER:
+        # Only the patch note div remains (lxml adds the doctype)
+        for element in list(soup.contents):
+            if element is not data_patch_notes:
+                element.extract()
+        patch_note.parsed = soup
+
+
+def download_all_patch_notes(patch_notes: List[PatchNote], skip_existing=True, workers=1, only_changed=False,
+                             checkpoint: Optional[LoadCheckpoint] = None) -> List[PatchNote]:
+    """
+    Downloads and saves the patch notes, already saved patch notes are skipped unless skip_existing is False. With
+    only_changed, downloaded patch notes are only saved again if the hash of their content differs from the saved
+    one. Returns the saved patch notes whose content was changed on the website.
+
+    The processed patch notes get added to the checkpoint, patch notes that are already in it are skipped.
+    """
     length = len(patch_notes)
+    existing = get_storage().content_keys() if skip_existing else set()
+    if checkpoint is not None:
+        existing = existing.union(checkpoint.done)
+    hashes = get_storage().content_hashes() if only_changed else {}  # type: Dict[str, str]
+    edited = []
+    pending = []
     for i, patch_note in enumerate(patch_notes):
-        save_path = f"{DOWNLOAD_PATH}/patch_notes_{patch_note.time.isoformat()}.html"
-        if skip_existing and os.path.exists(save_path):
-            logger.info("Processing %s [%s/%s]: File exists - skipping",
-                        patch_note.time.isoformat(), i + 1, length)
+        key = patch_note.time.isoformat()
+        if key in existing:
+            logger.info("Processing %s [%s/%s]: File exists - skipping", key, i + 1, length)
             continue
-        logger.info("Processing %s [%s/%s]: Downloading %s",
-                    patch_note.time.isoformat(), i + 1, length, patch_note.url)
-        download_patch_note(patch_note, save_path)
+        if workers <= 1:
+            logger.info("Processing %s [%s/%s]: Downloading %s", key, i + 1, length, patch_note.url)
+            if download_patch_note(patch_note, hashes.get(key)) and key in hashes:
+                edited.append(patch_note)
+            if checkpoint is not None:
+                checkpoint.add_done(patch_note)
+        else:
+            pending.append(patch_note)
+    if len(pending) > 0:
+        edited.extend(_download_concurrent(pending, workers, hashes, checkpoint))
+    if len(edited) > 0:
+        metrics.inc("patch_notes_edited", len(edited))
+        logger.info("%s patch notes were changed on the website: %s",
+                    len(edited), ", ".join(p.time.isoformat() for p in edited))
+    return edited
+
+
+def _download_concurrent(pending: List[PatchNote], workers: int, hashes: Dict[str, str],
+                         checkpoint: Optional[LoadCheckpoint]) -> List[PatchNote]:
+    # The worker threads only fetch the pages (the shared limiter keeps the global rate limit), parsing and saving
+    # happens in this thread so the next requests don't have to wait for BeautifulSoup
+    length = len(pending)
+    logger.info("Downloading %s patch notes with %s workers", length, workers)
+    edited = []
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ee-download")
+    try:
+        futures = {executor.submit(fetch_page, patch_note.url): patch_note for patch_note in pending}
+        for i, future in enumerate(as_completed(futures)):
+            patch_note = futures[future]
+            logger.info("Processing %s [%s/%s]: Downloaded %s",
+                        patch_note.time.isoformat(), i + 1, length, patch_note.url)
+            extract_patch_note(patch_note, future.result().content)
+            key = patch_note.time.isoformat()
+            if _save_changed_patch_note(patch_note, hashes.get(key)) and key in hashes:
+                edited.append(patch_note)
+            if checkpoint is not None:
+                checkpoint.add_done(patch_note)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return edited
 
 
 def has_missing_notes(patch_notes: List[PatchNote]) -> bool:
+    existing = get_storage().content_keys()
     for patch_note in patch_notes:
-        save_path = f"{DOWNLOAD_PATH}/patch_notes_{patch_note.time.isoformat()}.html"
-        if not os.path.exists(save_path):
+        if patch_note.time.isoformat() not in existing:
             return True
     return False
 
 
-def download_new_patch_notes(base_url: str, stop_at=4) -> None:
+def find_broken_patch_notes() -> List[str]:
+    """Checks the saved patch notes for empty, truncated or modified content, returns the keys of the broken ones"""
+    broken = get_storage().check_integrity()
+    for key in broken:
+        logger.warning("The saved patch notes %s are broken", key)
+    logger.info("Checked the saved patch notes, found %s broken patch notes", len(broken))
+    metrics.inc("patch_notes_broken", len(broken))
+    return broken
+
+
+def find_new_patch_notes(base_url: str, last_page: int, newest: str) -> List[PatchNote]:
+    """
+    Returns the patch notes of all overview pages up to the first page that contains a patch note which is not newer
+    than the newest saved patch note (iso date). The overview pages are sorted by date, this boundary page gets
+    located with an exponential and a binary search, so holes in the older saved patch notes don't matter. Only the
+    pages before the boundary have to be loaded additionally.
+    """
+    pages = {}  # type: Dict[int, List[PatchNote]]
+
+    def _load(i: int) -> List[PatchNote]:
+        if i not in pages:
+            pages[i] = find_all_patch_notes_urls(base_url=base_url, max_index=i, min_index=i, cache=False)
+        return pages[i]
+
+    def _reaches_saved(i: int) -> bool:
+        notes = _load(i)
+        return len(notes) == 0 or min(p.time.isoformat() for p in notes) <= newest
+
+    # The pages up to low only contain new patch notes, the boundary is at most high
+    low, high = 0, 1
+    while high < last_page and not _reaches_saved(high):
+        low, high = high, min(high * 2, last_page)
+    while high - low > 1:
+        mid = (low + high) // 2
+        if _reaches_saved(mid):
+            high = mid
+        else:
+            low = mid
+    logger.info("Found saved patch notes on page %s after loading %s pages", high, len(pages))
+    return [p for i in range(1, high + 1) for p in _load(i)]
+
+
+def download_new_patch_notes(base_url: str, stop_at=4, workers=1) -> List[PatchNote]:
     logger.info("Loading missing patch notes")
-    new_notes = []
-    for i in range(1, stop_at + 1):
-        patch_notes = find_all_patch_notes_urls(base_url=base_url, max_index=i, min_index=i, cache=False)
-        if not has_missing_notes(patch_notes):
-            logger.info("Page %s has no new patch notes, stopping search", i)
-            break
-        new_notes.extend(patch_notes)
-        download_all_patch_notes(patch_notes)
-    append_patch_note_cache(new_notes)
+    existing = get_storage().content_keys()
+    if len(existing) == 0:
+        logger.info("No saved patch notes found, loading all pages")
+        patch_notes = find_all_patch_notes_urls(base_url=base_url, max_index=stop_at, cache=False)
+    else:
+        patch_notes = find_new_patch_notes(base_url, stop_at, max(existing))
+    new_notes = [p for p in patch_notes if p.time.isoformat() not in existing]
+    logger.info("Found %s new patch notes", len(new_notes))
+    download_all_patch_notes(new_notes, skip_existing=False, workers=workers)
+    if len(new_notes) > 0:
+        append_patch_note_cache(new_notes)
+    return new_notes
+
+
+def replay_patch_notes(base_url: str) -> List[PatchNote]:
+    """
+    Runs the discovery and the extraction again with the archived responses (REPLAY has to be enabled). The patch notes
+    of all archived overview pages are added to the saved ones, the patch notes with an archived page get extracted
+    again and saved if their content changed. Returns the changed patch notes.
+    """
+    known = {p.time: p for p in load_patch_notes_from_cache()}
+    last_page = load_page_range(_overview_url(base_url, 1))
+    for i in range(1, last_page + 1):
+        url = _overview_url(base_url, i)
+        if url not in archive:
+            logger.warning("Overview page %s is not archived", url)
+            continue
+        for patch_note in extract_patch_notes_urls(url):
+            known.setdefault(patch_note.time, patch_note)
+    patch_notes = sorted(known.values(), key=lambda p: p.time, reverse=True)
+    save_patch_note_cache(patch_notes)
+    archived = [p for p in patch_notes if p.url in archive]
+    logger.info("Extracting %s of %s patch notes from the archive", len(archived), len(patch_notes))
+    return download_all_patch_notes(archived, skip_existing=False, only_changed=True)
+
+
+class PatchNoteWatcher:
+    """
+    Checks the first overview page for new patch notes, for long-running processes. The known patch notes are kept
+    in memory, a check only costs one (conditional) request as long as there are no new patch notes. If all patch
+    notes on the first page are new, the remaining new patch notes are searched like in download_new_patch_notes.
+    """
+
+    def __init__(self, base_url: str, workers: int = 1):
+        self.base_url = base_url
+        self.workers = workers
+        self.patch_notes = load_patch_notes_from_cache()
+        self.known = get_storage().content_keys()
+
+    def poll(self) -> List[PatchNote]:
+        """Downloads the new patch notes and returns them"""
+        home_url = self.base_url.format(index="")
+        page_notes = extract_patch_notes_urls(home_url)
+        new_notes = [p for p in page_notes if p.time.isoformat() not in self.known]
+        if len(new_notes) == 0:
+            return []
+        if len(new_notes) == len(page_notes):
+            # There might be more new patch notes on the next pages
+            new_notes = download_new_patch_notes(self.base_url, stop_at=load_page_range(home_url),
+                                                 workers=self.workers)
+        else:
+            download_all_patch_notes(new_notes, skip_existing=False, workers=self.workers)
+            append_patch_note_cache(new_notes)
+        self.known.update(p.time.isoformat() for p in new_notes)
+        listed = {p.time for p in self.patch_notes}
+        self.patch_notes.extend(p for p in new_notes if p.time not in listed)
+        logger.info("Downloaded %s new patch notes", len(new_notes))
+        return new_notes
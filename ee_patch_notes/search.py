@@ -0,0 +1,80 @@
+import json
+import re
+from typing import Dict, List, Any, Optional
+
+from bs4 import Tag, NavigableString, Comment
+
+RE_TERM = re.compile(r"\w+")
+MIN_TERM_LENGTH = 2
+STOP_WORDS = {"the", "and", "for", "to", "of", "in", "on", "is", "be", "are", "a", "an", "or", "it", "its", "at",
+              "as", "by", "with", "from", "this", "that", "will", "has", "have", "can", "all", "not", "we", "you"}
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in RE_TERM.findall(text.lower()) if len(t) >= MIN_TERM_LENGTH and t not in STOP_WORDS]
+
+
+def extract_entries(patch_note_tag: Tag) -> Dict[str, Any]:
+    """
+    Extracts the search index entries from a formatted patch note. Every section (the title and every h3/h4 heading)
+    is a separate document with its anchor id and a label.
+
+    :return: A dict with the documents as list of ``[anchor, label]`` and the terms as dict with the indices of the
+        documents that contain the term.
+    """
+    title_tag = patch_note_tag.find("div", class_="patch-title")
+    date_tag = title_tag.find("p", class_="date") if title_tag is not None else None
+    date_str = date_tag.get_text(" ", strip=True) if date_tag is not None else ""
+    title = title_tag.find(string=True, recursive=False) if title_tag is not None else None
+    title = title.strip() if title is not None else patch_note_tag.get("id")
+    docs = [[patch_note_tag.get("id"), f"{date_str} {title}".strip()]]
+    terms = {}  # type: Dict[str, List[int]]
+    for element in patch_note_tag.descendants:
+        if isinstance(element, Tag) and element.name in ("h3", "h4") and element.get("id") is not None:
+            docs.append([element["id"], f"{date_str} {element.get_text(' ', strip=True)}".strip()])
+        elif isinstance(element, NavigableString) and not isinstance(element, Comment):
+            doc = len(docs) - 1
+            for term in tokenize(element):
+                postings = terms.setdefault(term, [])
+                if len(postings) == 0 or postings[-1] != doc:
+                    postings.append(doc)
+    return {"docs": docs, "terms": terms}
+
+
+class SearchIndexBuilder:
+    """Combines the search index entries of all patch notes into one inverted index"""
+
+    def __init__(self):
+        self.docs = []  # type: List[List[str]]
+        self.terms = {}  # type: Dict[str, List[int]]
+
+    def add(self, entries: Dict[str, Any], page: Optional[str] = None) -> None:
+        """Adds the entries of a patch note (or of another builder), the anchors can be prefixed with a page url"""
+        offset = len(self.docs)
+        if page is None:
+            self.docs.extend(entries["docs"])
+        else:
+            self.docs.extend([f"{page}#{anchor}", label] for anchor, label in entries["docs"])
+        for term, postings in entries["terms"].items():
+            self.terms.setdefault(term, []).extend(doc + offset for doc in postings)
+
+    def to_entries(self) -> Dict[str, Any]:
+        return {"docs": self.docs, "terms": self.terms}
+
+    def to_json(self) -> str:
+        """
+        Serializes the index for embedding it into a <script> tag. The postings are delta encoded (every number is the
+        difference to the previous document index) to keep the index small.
+        """
+        terms = {}
+        for term, postings in self.terms.items():
+            last = 0
+            encoded = []
+            for doc in postings:
+                encoded.append(doc - last)
+                last = doc
+            terms[term] = encoded
+        raw = json.dumps({"docs": self.docs, "terms": terms, "stop": sorted(STOP_WORDS), "min": MIN_TERM_LENGTH},
+                         ensure_ascii=False, separators=(",", ":"))
+        # The index must not close the <script> tag
+        return raw.replace("</", "<\\/")
@@ -0,0 +1,592 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import List, Dict, Optional, Iterable, Set, Tuple, Callable
+
+logger = logging.getLogger("ee.storage")
+SQLITE_MAX_PARAMS = 500
+PACK_INDEX = "patch_notes.idx"
+RE_PACK_FILE = re.compile(r"patch_notes\.\d+\.pack")
+
+RE_CONTENT_FILE = re.compile(r"^patch_notes_(\d{4}-\d{2}-\d{2})\.html$")
+# The metadata journal gets compacted if it has more than COMPACT_FACTOR records per patch note (and at least
+# COMPACT_MIN_RECORDS records)
+COMPACT_MIN_RECORDS = 100
+COMPACT_FACTOR = 2
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def _check_contents(load: Callable[[str], str], hashes: Dict[str, Optional[str]], workers: int) -> List[str]:
+    """Loads the content of the given patch notes in parallel, returns the keys of the broken patch notes"""
+    def _is_broken(key: str) -> bool:
+        try:
+            content = load(key)
+        except (KeyError, OSError, ValueError, zlib.error):
+            return True
+        # The content is the serialized patch note div, all divs are closed unless it was cut off
+        if not content.rstrip().endswith("</div>") or content.count("<div") != content.count("</div>"):
+            return True
+        return hashes[key] is not None and content_hash(content) != hashes[key]
+
+    keys = sorted(hashes)
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ee-check") as executor:
+        return [key for key, broken in zip(keys, executor.map(_is_broken, keys)) if broken]
+
+
+class Storage:
+    """
+    Base class for the storage of the patch note metadata (the meta dicts of ``PatchNote.to_meta_dict``) and the
+    extracted patch note content. Both are keyed by the release date of the patch note in iso format.
+    """
+
+    def load_meta(self) -> List[Dict[str, Optional[str]]]:
+        raise NotImplementedError()
+
+    def save_meta(self, entries: List[Dict[str, Optional[str]]]) -> None:
+        """Replaces the saved metadata with the given entries"""
+        raise NotImplementedError()
+
+    def append_meta(self, entries: List[Dict[str, Optional[str]]]) -> None:
+        """Adds the given entries to the saved metadata, existing entries with the same key get replaced"""
+        raise NotImplementedError()
+
+    def content_keys(self) -> Set[str]:
+        """Returns the keys of all patch notes with saved content"""
+        raise NotImplementedError()
+
+    def has_content(self, key: str) -> bool:
+        return key in self.content_keys()
+
+    def content_hashes(self) -> Dict[str, str]:
+        """Returns the hash (``content_hash``) of the content of all patch notes with saved content"""
+        return {key: content_hash(content) for key, content in self.load_contents(self.content_keys()).items()}
+
+    def check_integrity(self, workers: int = 4) -> List[str]:
+        """Returns the keys of the patch notes whose saved content is empty, truncated or doesn't match its hash"""
+        return _check_contents(self.load_content, dict(self.content_hashes()), workers)
+
+    def load_content(self, key: str) -> str:
+        """Returns the content of the patch note, raises a KeyError if there is no saved content"""
+        raise NotImplementedError()
+
+    def load_contents(self, keys: Iterable[str]) -> Dict[str, str]:
+        """Returns the content of all given patch notes, raises a KeyError if the content of a patch note is missing"""
+        return {key: self.load_content(key) for key in keys}
+
+    def save_content(self, key: str, content: str) -> None:
+        raise NotImplementedError()
+
+    def save_contents(self, contents: Dict[str, str]) -> None:
+        for key, content in contents.items():
+            self.save_content(key, content)
+
+    def close(self) -> None:
+        pass
+
+
+class Manifest:
+    """
+    Index of the patch note files in a directory with the size, the modification time and the hash of every file.
+
+    The manifest gets saved as json file next to the patch notes. When it is loaded, it is validated with a single scan
+    of the directory: new files get added, removed files get dropped and the hash of modified files (different size or
+    modification time) is discarded. Missing hashes are only computed when they are requested.
+    """
+
+    def __init__(self, directory: str, path: str):
+        self.directory = directory
+        self.path = path
+        self.dirty = False
+        self._lock = threading.Lock()
+        self._entries = {}  # type: Dict[str, List]
+        self._load()
+
+    def _load(self) -> None:
+        saved = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                saved = json.load(file)["entries"]
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, KeyError):
+            logger.warning("Ignoring the broken manifest %s", self.path)
+        if os.path.exists(self.directory):
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    match = RE_CONTENT_FILE.match(entry.name)
+                    if match is None:
+                        continue
+                    key = match.group(1)
+                    stat = entry.stat()
+                    old = saved.get(key)
+                    file_hash = None
+                    if old is not None and old[0] == stat.st_size and old[1] == stat.st_mtime_ns:
+                        file_hash = old[2]
+                    self._entries[key] = [stat.st_size, stat.st_mtime_ns, file_hash]
+        self.dirty = self._entries != saved
+
+    def save(self) -> None:
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump({"entries": self._entries}, file)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+    def keys(self) -> Set[str]:
+        with self._lock:
+            return set(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def size(self, key: str) -> int:
+        """Returns the size of the file in bytes, raises a KeyError if there is no file"""
+        return self._entries[key][0]
+
+    def hash(self, key: str) -> Optional[str]:
+        """Returns the hash of the file content, None if it was not computed since the file was changed"""
+        return self._entries[key][2]
+
+    def hashes(self) -> Dict[str, Optional[str]]:
+        with self._lock:
+            return {key: entry[2] for key, entry in self._entries.items()}
+
+    def update(self, key: str, file_path: str, file_hash: Optional[str]) -> None:
+        stat = os.stat(file_path)
+        with self._lock:
+            self._entries[key] = [stat.st_size, stat.st_mtime_ns, file_hash]
+            self.dirty = True
+
+    def set_hash(self, key: str, file_hash: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._entries[key][2] = file_hash
+                self.dirty = True
+
+
+class FileStorage(Storage):
+    """
+    The default storage, every patch note is saved as ``patch_notes_<date>.html`` inside a directory. The saved files
+    are listed in a ``Manifest`` (``manifest.json``), which gets loaded with the first access.
+
+    The metadata is saved in an append-only journal with one json record per line, later records replace earlier ones
+    with the same key. The journal gets compacted (rewritten with only the latest records) while loading it, if it
+    contains too many outdated records. A cache file of older versions (a single json object with all entries) can
+    still be read, it gets replaced by a journal with the next write.
+    """
+
+    def __init__(self, path: str, cache_path: str):
+        self.path = path
+        self.cache_path = cache_path
+        self.manifest_path = f"{path}/manifest.json"
+        self._manifest = None  # type: Manifest | None
+
+    @property
+    def manifest(self) -> Manifest:
+        if self._manifest is None:
+            self._manifest = Manifest(self.path, self.manifest_path)
+        return self._manifest
+
+    def _content_path(self, key: str) -> str:
+        return f"{self.path}/patch_notes_{key}.html"
+
+    def _legacy_cache_path(self) -> Optional[str]:
+        root, ext = os.path.splitext(self.cache_path)
+        return f"{root}.json" if ext == ".jsonl" else None
+
+    def _read_cache(self) -> Tuple[Dict[str, Dict[str, Optional[str]]], int]:
+        """Returns the latest record for every key and the number of records in the journal"""
+        path = self.cache_path
+        if not os.path.exists(path):
+            path = self._legacy_cache_path()
+            if path is None or not os.path.exists(path):
+                logger.warning("Patch note cache file not found: %s", self.cache_path)
+                return {}, 0
+        raw = {}
+        records = 0
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                if len(line.strip()) == 0:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Only the last record can be incomplete (if a write was interrupted)
+                    logger.warning("Skipping incomplete record in %s", path)
+                    continue
+                if "time" in record:
+                    records += 1
+                    raw[record["time"]] = record
+                else:
+                    # A cache file of older versions with all entries in one object
+                    records += len(record)
+                    raw.update(record)
+        return raw, records
+
+    def _write_cache(self, raw: Dict[str, Dict[str, Optional[str]]]) -> None:
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            for entry in raw.values():
+                file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.cache_path)
+        logger.info("Dumped patch note metadata to %s", self.cache_path)
+
+    def load_meta(self) -> List[Dict[str, Optional[str]]]:
+        raw, records = self._read_cache()
+        if os.path.exists(self.cache_path) and records > max(COMPACT_MIN_RECORDS, COMPACT_FACTOR * len(raw)):
+            logger.info("Compacting %s records of %s patch notes in %s", records, len(raw), self.cache_path)
+            self._write_cache(raw)
+        return list(raw.values())
+
+    def save_meta(self, entries: List[Dict[str, Optional[str]]]) -> None:
+        self._write_cache({entry["time"]: entry for entry in entries})
+
+    def append_meta(self, entries: List[Dict[str, Optional[str]]]) -> None:
+        if not os.path.exists(self.cache_path):
+            raw, _ = self._read_cache()
+            for entry in entries:
+                raw[entry["time"]] = entry
+            self._write_cache(raw)
+            return
+        with open(self.cache_path, "rb+") as file:
+            # Don't continue an incomplete record of an interrupted write
+            file.seek(0, os.SEEK_END)
+            if file.tell() > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    file.write(b"\n")
+            file.write("".join(json.dumps(entry) + "\n" for entry in entries).encode("utf-8"))
+            file.flush()
+            os.fsync(file.fileno())
+        logger.info("Appended metadata of %s patch notes to %s", len(entries), self.cache_path)
+
+    def content_keys(self) -> Set[str]:
+        return self.manifest.keys()
+
+    def has_content(self, key: str) -> bool:
+        return key in self.manifest
+
+    def content_hashes(self) -> Dict[str, str]:
+        hashes = self.manifest.hashes()
+        for key, file_hash in hashes.items():
+            if file_hash is None:
+                hashes[key] = content_hash(self.load_content(key))
+                self.manifest.set_hash(key, hashes[key])
+        return hashes
+
+    def check_integrity(self, workers: int = 4) -> List[str]:
+        # Only the already known hashes are compared, the other files are checked for truncation
+        return _check_contents(self.load_content, self.manifest.hashes(), workers)
+
+    def load_content(self, key: str) -> str:
+        try:
+            with open(self._content_path(key), "r", encoding="utf-8") as file:
+                return file.read()
+        except FileNotFoundError as e:
+            raise KeyError(key) from e
+
+    def save_content(self, key: str, content: str) -> None:
+        with open(self._content_path(key), "w", encoding="utf-8") as file:
+            file.write(content)
+        if self._manifest is not None:
+            # Otherwise the new file gets found with the scan while loading the manifest
+            self._manifest.update(key, self._content_path(key), content_hash(content))
+
+    def close(self) -> None:
+        if self._manifest is not None and self._manifest.dirty:
+            self._manifest.save()
+
+
+class SQLiteStorage(Storage):
+    """
+    Saves the metadata and the content of all patch notes in a single SQLite database (in WAL mode). Additionally, the
+    hash of the content and the time it was fetched get saved for every patch note.
+
+    Patch notes that are removed from the metadata (by ``save_meta``) keep their content, like the files of the
+    file storage.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS patch_notes ("
+                "time TEXT PRIMARY KEY, "
+                "url TEXT, "
+                "content TEXT, "
+                "content_hash TEXT, "
+                "fetched_at TEXT)")
+
+    def load_meta(self) -> List[Dict[str, Optional[str]]]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT url, time FROM patch_notes WHERE url IS NOT NULL ORDER BY time DESC").fetchall()
+        return [{"url": url, "time": time} for url, time in rows]
+
+    def _upsert_meta(self, entries: List[Dict[str, Optional[str]]]) -> None:
+        self._connection.executemany(
+            "INSERT INTO patch_notes (time, url) VALUES (?, ?) ON CONFLICT(time) DO UPDATE SET url = excluded.url",
+            [(entry["time"], entry["url"]) for entry in entries])
+
+    def save_meta(self, entries: List[Dict[str, Optional[str]]]) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE patch_notes SET url = NULL")
+            self._upsert_meta(entries)
+        logger.info("Saved metadata of %s patch notes to %s", len(entries), self.path)
+
+    def append_meta(self, entries: List[Dict[str, Optional[str]]]) -> None:
+        with self._lock, self._connection:
+            self._upsert_meta(entries)
+        logger.info("Saved metadata of %s patch notes to %s", len(entries), self.path)
+
+    def content_keys(self) -> Set[str]:
+        with self._lock:
+            rows = self._connection.execute("SELECT time FROM patch_notes WHERE content IS NOT NULL").fetchall()
+        return {time for time, in rows}
+
+    def has_content(self, key: str) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM patch_notes WHERE time = ? AND content IS NOT NULL", (key,)).fetchone()
+        return row is not None
+
+    def content_hashes(self) -> Dict[str, str]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT time, content_hash FROM patch_notes WHERE content IS NOT NULL").fetchall()
+        return dict(rows)
+
+    def load_content(self, key: str) -> str:
+        with self._lock:
+            row = self._connection.execute("SELECT content FROM patch_notes WHERE time = ?", (key,)).fetchone()
+        if row is None or row[0] is None:
+            raise KeyError(key)
+        return row[0]
+
+    def load_contents(self, keys: Iterable[str]) -> Dict[str, str]:
+        keys = sorted(set(keys))
+        contents = {}  # type: Dict[str, str]
+        with self._lock:
+            # Older SQLite versions allow at most 999 parameters per query
+            for i in range(0, len(keys), SQLITE_MAX_PARAMS):
+                batch = keys[i:i + SQLITE_MAX_PARAMS]
+                rows = self._connection.execute(
+                    f"SELECT time, content FROM patch_notes WHERE content IS NOT NULL "
+                    f"AND time IN ({', '.join('?' * len(batch))})", batch).fetchall()
+                contents.update(rows)
+        missing = set(keys).difference(contents)
+        if len(missing) > 0:
+            raise KeyError(min(missing))
+        return contents
+
+    def save_content(self, key: str, content: str) -> None:
+        self.save_contents({key: content})
+
+    def save_contents(self, contents: Dict[str, str]) -> None:
+        fetched_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO patch_notes (time, content, content_hash, fetched_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(time) DO UPDATE SET content = excluded.content, content_hash = excluded.content_hash, "
+                "fetched_at = excluded.fetched_at",
+                [(key, content, content_hash(content), fetched_at)
+                 for key, content in contents.items()])
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class PackStorage(FileStorage):
+    """
+    Saves the content of all patch notes compressed (zlib) in a single pack file, the metadata is saved like in the
+    file storage.
+
+    The compressed patch notes are appended to the pack file, an index (``patch_notes.idx``) contains the offset,
+    the compressed and uncompressed size and the hash of every patch note. Like the manifest of the file storage, the
+    index is only written when the storage gets closed, patch notes appended after the last written index are missing
+    from the storage after a crash. The pack file is read via mmap. Replaced patch notes stay in the pack file until it
+    gets compacted, which happens when the storage gets closed and more than half of the pack file is outdated. The
+    compaction writes a new pack file, the index is switched to the new pack file atomically.
+    """
+
+    def __init__(self, path: str, cache_path: str, level: int = 6, index_path: Optional[str] = None):
+        super().__init__(path, cache_path)
+        self.index_path = index_path if index_path is not None else f"{path}/{PACK_INDEX}"
+        self.level = level
+        self._lock = threading.Lock()
+        self._pack = "patch_notes.0.pack"
+        self._entries = {}  # type: Dict[str, List]
+        self._map = None  # type: mmap.mmap | None
+        self._dirty = False
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                index = json.load(file)
+            self._pack = index["pack"]
+            self._entries = index["entries"]
+
+    @property
+    def pack_path(self) -> str:
+        return f"{self.path}/{self._pack}"
+
+    def _save_index(self) -> None:
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"pack": self._pack, "entries": self._entries}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.index_path)
+        self._dirty = False
+
+    def _close_map(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _read(self, key: str) -> str:
+        entry = self._entries.get(key)
+        if entry is None:
+            raise KeyError(key)
+        offset, length = entry[0], entry[1]
+        if self._map is None or offset + length > len(self._map):
+            # The pack file grew since it was mapped
+            self._close_map()
+            with open(self.pack_path, "rb") as file:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return zlib.decompress(self._map[offset:offset + length]).decode("utf-8")
+
+    def content_keys(self) -> Set[str]:
+        with self._lock:
+            return set(self._entries)
+
+    def has_content(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def content_hashes(self) -> Dict[str, str]:
+        with self._lock:
+            return {key: entry[3] for key, entry in self._entries.items()}
+
+    def check_integrity(self, workers: int = 4) -> List[str]:
+        return Storage.check_integrity(self, workers)
+
+    def load_content(self, key: str) -> str:
+        with self._lock:
+            return self._read(key)
+
+    def load_contents(self, keys: Iterable[str]) -> Dict[str, str]:
+        with self._lock:
+            # Read the pack file sequentially
+            ordered = sorted(keys, key=lambda k: self._entries[k][0] if k in self._entries else -1)
+            return {key: self._read(key) for key in ordered}
+
+    def save_content(self, key: str, content: str) -> None:
+        self.save_contents({key: content})
+
+    def save_contents(self, contents: Dict[str, str]) -> None:
+        with self._lock:
+            self._append(self.pack_path, contents)
+            self._dirty = True
+
+    def _append(self, pack_path: str, contents: Dict[str, str]) -> None:
+        with open(pack_path, "ab") as file:
+            offset = file.seek(0, os.SEEK_END)
+            for key, content in contents.items():
+                raw = content.encode("utf-8")
+                data = zlib.compress(raw, self.level)
+                file.write(data)
+                self._entries[key] = [offset, len(data), len(raw), hashlib.sha256(raw).hexdigest()]
+                offset += len(data)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def compact(self) -> None:
+        """Rewrites the pack file without the outdated patch notes"""
+        with self._lock:
+            old_path = self.pack_path
+            contents = {key: self._read(key) for key in sorted(self._entries, key=lambda k: self._entries[k][0])}
+            generation = int(self._pack.split(".")[1]) + 1
+            self._pack = f"patch_notes.{generation}.pack"
+            self._append(self.pack_path, contents)
+            self._save_index()
+            self._close_map()
+            if os.path.exists(old_path):
+                os.remove(old_path)
+        logger.info("Compacted %s to %s", old_path, self.pack_path)
+
+    def close(self) -> None:
+        size = os.path.getsize(self.pack_path) if os.path.exists(self.pack_path) else 0
+        live = sum(entry[1] for entry in self._entries.values())
+        if size - live > live:
+            self.compact()
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+            self._close_map()
+
+
+def migrate(source: Storage, target: Storage, batch_size: int = 100) -> None:
+    """Copies the metadata and the content of all patch notes from one storage to another one"""
+    entries = source.load_meta()
+    target.save_meta(entries)
+    keys = sorted(source.content_keys())
+    for i in range(0, len(keys), batch_size):
+        target.save_contents(source.load_contents(keys[i:i + batch_size]))
+    logger.info("Migrated %s patch notes and the metadata of %s patch notes", len(keys), len(entries))
+
+
+def migrate_to_sqlite(source: Storage, path: str) -> None:
+    """
+    Migrates the patch notes into a new SQLite database. The migration writes into a temporary database that replaces
+    the target only once it is complete, an interrupted migration gets started again by the next run.
+    """
+    tmp_path = f"{path}.tmp"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(tmp_path + suffix):
+            os.remove(tmp_path + suffix)
+    target = SQLiteStorage(tmp_path)
+    try:
+        migrate(source, target)
+    finally:
+        # Closing the last connection merges the WAL into the database file
+        target.close()
+    os.replace(tmp_path, path)
+
+
+def migrate_to_pack(source: Storage, path: str, cache_path: str) -> None:
+    """
+    Migrates the patch notes into a new pack storage. The index is written to a temporary file during the migration
+    and only renamed to the index of the pack storage once it is complete, without an index the pack files of an
+    interrupted migration get removed and the migration is started again.
+    """
+    index_path = f"{path}/{PACK_INDEX}"
+    tmp_index_path = f"{index_path}.migrating"
+    for name in os.listdir(path):
+        if RE_PACK_FILE.fullmatch(name) is not None or f"{path}/{name}" == tmp_index_path:
+            os.remove(f"{path}/{name}")
+    target = PackStorage(path, cache_path, index_path=tmp_index_path)
+    try:
+        migrate(source, target)
+        # Without saved patch notes nothing has written the index yet
+        target._save_index()
+    finally:
+        target.close()
+    os.replace(tmp_index_path, index_path)
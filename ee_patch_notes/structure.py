@@ -0,0 +1,61 @@
+from typing import Dict, Any, List, Optional
+
+from bs4 import Tag, NavigableString, Comment
+
+
+def _section(title: Optional[str], anchor: Optional[str], subsections: bool) -> Dict[str, Any]:
+    section = {"title": title, "anchor": anchor, "items": []}  # type: Dict[str, Any]
+    if subsections:
+        section["subsections"] = []
+    return section
+
+
+def _items(element: Tag | NavigableString) -> List[str]:
+    if isinstance(element, Comment):
+        return []
+    if isinstance(element, Tag) and element.name in ("ul", "ol"):
+        # Nested lists stay part of the text of their item
+        return [text for text in (li.get_text(" ", strip=True) for li in element.find_all("li", recursive=False))
+                if len(text) > 0]
+    text = element.get_text(" ", strip=True) if isinstance(element, Tag) else element.strip()
+    return [text] if len(text) > 0 else []
+
+
+def extract_structure(patch_note_tag: Tag) -> Dict[str, Any]:
+    """
+    Extracts the structure of a formatted patch note: the title, the sections (h3 headings) with their subsections
+    (h4 headings) and the items (list items and paragraphs) of every section. Items before the first heading belong to
+    the patch note itself, subsections before the first section get a section without title.
+
+    The date and the url are not part of the formatted patch note, they get added when the structure is written.
+
+    :return: A dict with the title, the anchor id, the items and the sections of the patch note, every section has a
+        title, an anchor id, the items and the subsections (with title, anchor id and items)
+    """
+    title_tag = patch_note_tag.find("div", class_="patch-title")
+    title = title_tag.find(string=True, recursive=False) if title_tag is not None else None
+    data = {
+        "title": title.strip() if title is not None else None,
+        "anchor": patch_note_tag.get("id"),
+        "items": [],
+        "sections": []
+    }  # type: Dict[str, Any]
+    content = patch_note_tag.find("div", class_="patch-content")
+    if content is None:
+        return data
+    section = None  # type: Dict[str, Any] | None
+    target = data
+    for element in content.children:
+        if isinstance(element, Tag) and element.name == "h3":
+            section = _section(element.get_text(" ", strip=True), element.get("id"), True)
+            data["sections"].append(section)
+            target = section
+        elif isinstance(element, Tag) and element.name == "h4":
+            if section is None:
+                section = _section(None, None, True)
+                data["sections"].append(section)
+            target = _section(element.get_text(" ", strip=True), element.get("id"), False)
+            section["subsections"].append(target)
+        else:
+            target["items"].extend(_items(element))
+    return data
@@ -1,10 +1,19 @@
 import argparse
+import cProfile
 import logging
 import os.path
+import pstats
 import shutil
+import signal
 import sys
+import threading
+from datetime import datetime
+from time import perf_counter
 
-from ee_patch_notes import scraper, formatter
+from ee_patch_notes import scraper, formatter, storage, metrics, parser as html_parser
+from ee_patch_notes.archive import ResponseArchive
+from ee_patch_notes.fragments import FragmentCache
+from ee_patch_notes.http_cache import HttpCache
 
 logger = logging.getLogger()
 
@@ -23,40 +32,60 @@ logger.setLevel(logging.INFO)
 # http.client.HTTPConnection.debuglevel = 1
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Patch notes scrapper for the game Eve Echoes")
-    parser.add_argument("mode",
-                        type=str, choices=["load_all", "load_new", "export_html", "load_all_export",
-                                           "load_new_export"],
-                        help="Select the mode, must be load_all, load_new, export_html, load_all_export, load_new_export")
-    parser.add_argument("output_path",
-                        type=str, help="The output directory")
-    parser.add_argument("-c", "--cache",
-                        help="Use the cached patch note urls (new patch notes will be missing), only effective for load_all",
-                        action="store_true")
-    parser.add_argument("-f", "--force_reload",
-                        help="Reload and overwrite already (locally) saved patch notes, only effective for load_all",
-                        action="store_true")
-    parser.add_argument("-url",
-                        help="The url for the patch notes, should contain {index} for the page number",
-                        default="https://www.eveechoes.com/news/updata/index{index}.html")
-    parser.add_argument("-r", "--ratelimit",
-                        help="The delay between http requests in seconds",
-                        default=1, type=float)
-    parser.add_argument("-rd", "--ratelimit_rnd_fac", type=float, default=2,
-                        help="A factor that gets multiplied with a random number between 0 and 1, the result will get "
-                             "added to the rate limit (will be random for every request)")
-    parser.add_argument("-cp", "--copy_to",
-                        help="Copy the generated html to the target path",
-                        default=None, type=str)
+def shard_type(value: str):
+    if value == "year":
+        return value
+    size = int(value)
+    if size <= 0:
+        raise argparse.ArgumentTypeError("The shard size must be positive")
+    return size
 
-    args = parser.parse_args()
+
+def setup(args):
     scraper.DOWNLOAD_PATH = f"{args.output_path}/patch_notes"
     if not os.path.exists(scraper.DOWNLOAD_PATH):
         os.makedirs(scraper.DOWNLOAD_PATH, exist_ok=True)
-    scraper.CACHE_PATH = f"{scraper.DOWNLOAD_PATH}/cache.json"
+    scraper.CACHE_PATH = f"{scraper.DOWNLOAD_PATH}/cache.jsonl"
     scraper.RATE_LIMIT_SECONDS = args.ratelimit
     scraper.RATE_LIMIT_RAND_FAC = args.ratelimit_rnd_fac
+    scraper.MAX_RETRIES = args.max_retries
+    if args.adaptive_ratelimit is not None:
+        scraper.limiter = scraper.AdaptiveRateLimiter(min_delay=args.adaptive_ratelimit,
+                                                      start_delay=args.ratelimit)
+    html_parser.set_parser(args.parser)
+    html_parser.set_parser(args.formatter_parser, formatter=True)
+    if args.storage == "sqlite":
+        db_path = f"{scraper.DOWNLOAD_PATH}/patch_notes.db"
+        if not os.path.exists(db_path):
+            logger.info("Migrating the saved patch notes to %s", db_path)
+            storage.migrate_to_sqlite(storage.FileStorage(scraper.DOWNLOAD_PATH, scraper.CACHE_PATH), db_path)
+        scraper.storage = storage.SQLiteStorage(db_path)
+    elif args.storage == "pack":
+        if not os.path.exists(f"{scraper.DOWNLOAD_PATH}/{storage.PACK_INDEX}"):
+            logger.info("Migrating the saved patch notes to a pack file in %s", scraper.DOWNLOAD_PATH)
+            storage.migrate_to_pack(storage.FileStorage(scraper.DOWNLOAD_PATH, scraper.CACHE_PATH),
+                                    scraper.DOWNLOAD_PATH, scraper.CACHE_PATH)
+        scraper.storage = storage.PackStorage(scraper.DOWNLOAD_PATH, scraper.CACHE_PATH)
+    else:
+        scraper.storage = storage.FileStorage(scraper.DOWNLOAD_PATH, scraper.CACHE_PATH)
+    if args.mode == "replay":
+        # The replayed pages must not replace the parsing results of the cached pages
+        scraper.REPLAY = True
+    elif not args.no_http_cache:
+        scraper.http_cache = HttpCache(f"{scraper.DOWNLOAD_PATH}/http_cache")
+    if not args.no_archive:
+        scraper.archive = ResponseArchive(f"{scraper.DOWNLOAD_PATH}/archive")
+
+
+def run(args):
+    if args.mode == "watch":
+        watch(args)
+        return
+    if args.mode == "replay":
+        logger.info("Replaying the archived pages, output directory is %s.", scraper.DOWNLOAD_PATH)
+        scraper.replay_patch_notes(args.url)
+        export(args)
+        return
     generate_html = "export" in args.mode
     load = None
     if args.mode.startswith("load_all"):
@@ -65,31 +94,284 @@ if __name__ == '__main__':
         load = "new"
     base_url = args.url
 
-    if load is not None:
+    if load is not None and args.adaptive_ratelimit is not None:
+        logger.info("Loading %s patchnotes, output directory is %s. Adaptive ratelimit starts at %s with a minimum of %s",
+                    load,
+                    scraper.DOWNLOAD_PATH,
+                    scraper.limiter.current_delay,
+                    args.adaptive_ratelimit)
+    elif load is not None:
         logger.info("Loading %s patchnotes, output directory is %s. Ratelimit is between %s and %s",
                     load,
                     scraper.DOWNLOAD_PATH,
                     scraper.RATE_LIMIT_SECONDS,
                     scraper.RATE_LIMIT_SECONDS + scraper.RATE_LIMIT_RAND_FAC)
 
+    if args.verify:
+        broken = set(scraper.find_broken_patch_notes())
+        if load is not None and len(broken) > 0:
+            logger.info("Downloading %s broken patch notes again", len(broken))
+            scraper.download_all_patch_notes(
+                [p for p in scraper.load_patch_notes_from_cache() if p.time.isoformat() in broken],
+                skip_existing=False, workers=args.workers)
+    # The downloaded patch notes are passed to the export with their content (and for load_new with their parsed
+    # content, keeping it for all patch notes would need too much memory), so it doesn't have to be loaded again
+    patch_notes = None
     if load == "all":
         last_page = scraper.load_page_range(home_url=base_url.format(index=""))
-        if args.cache:
-            patch_notes = scraper.load_patch_notes_from_cache()
-        else:
-            patch_notes = scraper.find_all_patch_notes_urls(
-               base_url=base_url,
-               max_index=last_page)
-        scraper.download_all_patch_notes(patch_notes, skip_existing=not args.force_reload)
+        checkpoint = scraper.LoadCheckpoint(f"{scraper.DOWNLOAD_PATH}/load_all.checkpoint.jsonl")
+        checkpoint.open(base_url, resume=args.resume)
+        try:
+            if args.cache:
+                patch_notes = scraper.load_patch_notes_from_cache()
+            else:
+                patch_notes = scraper.find_all_patch_notes_urls(
+                   base_url=base_url,
+                   max_index=last_page,
+                   checkpoint=checkpoint)
+            scraper.download_all_patch_notes(patch_notes, skip_existing=not args.force_reload, workers=args.workers,
+                                             only_changed=args.force_reload, checkpoint=checkpoint)
+            checkpoint.finish()
+        finally:
+            checkpoint.close()
     elif load == "new":
         last_page = scraper.load_page_range(home_url=base_url.format(index=""))
-        scraper.download_new_patch_notes(base_url=base_url, stop_at=last_page)
+        scraper.KEEP_PARSED = generate_html
+        new_notes = {p.time: p for p in scraper.download_new_patch_notes(base_url=base_url, stop_at=last_page,
+                                                                         workers=args.workers)}
+        patch_notes = [new_notes.get(p.time, p) for p in scraper.load_patch_notes_from_cache()]
     if generate_html:
-        out_path = f"{args.output_path}/patch_notes.html"
-        logger.info("Generating html, output file is %s.", out_path)
+        export(args, patch_notes)
+
+
+def watch(args):
+    scraper.KEEP_PARSED = True
+    watcher = scraper.PatchNoteWatcher(args.url, workers=args.workers)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    logger.info("Watching for new patchnotes every %s seconds, output directory is %s.",
+                args.interval, scraper.DOWNLOAD_PATH)
+    try:
+        while not stop.is_set():
+            start_time = datetime.now()
+            start = perf_counter()
+            success = False
+            try:
+                new_notes = watcher.poll()
+                if len(new_notes) > 0:
+                    export(args, watcher.patch_notes)
+                    for patch_note in new_notes:
+                        patch_note.release_content()
+                success = True
+            except Exception:
+                # Try again at the next check instead of stopping the watcher, a KeyboardInterrupt still stops it
+                logger.exception("Checking for new patchnotes failed")
+            if args.metrics is not None or args.prometheus is not None:
+                write_metrics(args, start_time, perf_counter() - start, success)
+            stop.wait(args.interval)
+    except KeyboardInterrupt:
+        pass
+    logger.info("Stopped watching for new patchnotes")
+
+
+def export(args, patch_notes=None):
+    if patch_notes is None:
         patch_notes = scraper.load_patch_notes_from_cache()
-        scraper.load_patch_notes_content(patch_notes)
-        formatter.export_html(patch_notes, out_path)
-        if args.copy_to is not None:
-            logger.info("Copying created file to %s", args.copy_to)
-            shutil.copy(out_path, args.copy_to)
+    fragment_cache = None
+    if not args.no_fragment_cache:
+        fragment_cache = FragmentCache(f"{args.output_path}/fragments", formatter.get_version())
+    export_workers = args.export_workers if args.export_workers > 0 else os.cpu_count()
+    formats = set(args.output_formats)
+    if args.json:
+        formats.add("json")
+    written = []
+    if args.shard is not None:
+        out_path = f"{args.output_path}/html"
+        logger.info("Generating sharded html, output directory is %s.", out_path)
+        written = formatter.export_sharded(patch_notes, out_path, fragment_cache=fragment_cache,
+                                           workers=export_workers,
+                                           shard_size=None if args.shard == "year" else args.shard,
+                                           structured="json" in formats)
+    else:
+        out_path = args.output_path
+    writers = []
+    if "html" in formats and args.shard is None:
+        writers.append(formatter.HtmlWriter(f"{out_path}/patch_notes.html"))
+    if "json" in formats and args.shard is None:
+        writers.append(formatter.JsonWriter(f"{out_path}/patch_notes.jsonl"))
+    if "markdown" in formats:
+        writers.append(formatter.MarkdownWriter(f"{out_path}/patch_notes.md"))
+    if "text" in formats:
+        writers.append(formatter.TextWriter(f"{out_path}/patch_notes.txt"))
+    if "atom" in formats:
+        writers.append(formatter.FeedWriter(f"{out_path}/feed.xml", args.url.format(index=""),
+                                            args.feed_size))
+    if len(writers) > 0:
+        # With shards the single file formats are built from the fragment cache that the sharded export just filled
+        logger.info("Generating %s, output directory is %s.",
+                    ", ".join(os.path.basename(writer.path) for writer in writers), out_path)
+        formatter.export_notes(patch_notes, writers, fragment_cache=fragment_cache, workers=export_workers)
+        written.extend(writer.path for writer in writers)
+    if args.copy_to is not None:
+        logger.info("Copying %s files to %s", len(written), args.copy_to)
+        if args.shard is not None or len(written) > 1:
+            os.makedirs(args.copy_to, exist_ok=True)
+        for file_path in written:
+            shutil.copy(file_path, args.copy_to)
+
+
+def write_metrics(args, start_time: datetime, wall_time: float, success: bool):
+    metrics.registry.set("last_run_timestamp_seconds", start_time.timestamp())
+    metrics.registry.set("last_run_success", 1 if success else 0)
+    metrics.registry.set("last_run_duration_seconds", wall_time)
+    if args.metrics is not None:
+        metrics.registry.write_json(args.metrics, {
+            "mode": args.mode,
+            "start": start_time.isoformat(timespec="seconds"),
+            "wall_time": wall_time,
+            "success": success
+        })
+        logger.info("Saved metrics to %s", args.metrics)
+    if args.prometheus is not None:
+        metrics.registry.write_prometheus(args.prometheus)
+        logger.info("Saved prometheus metrics to %s", args.prometheus)
+
+
+def write_profile(profiler: cProfile.Profile, path: str):
+    if path.endswith(".prof"):
+        # Binary format for tools like snakeviz
+        profiler.dump_stats(path)
+    else:
+        with open(path, "w", encoding="utf-8") as file:
+            pstats.Stats(profiler, stream=file).sort_stats("cumulative").print_stats()
+    logger.info("Saved profile to %s", path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Patch notes scrapper for the game Eve Echoes")
+    parser.add_argument("mode",
+                        type=str, choices=["load_all", "load_new", "export_html", "load_all_export",
+                                           "load_new_export", "watch", "replay"],
+                        help="Select the mode, must be load_all, load_new, export_html, load_all_export, "
+                             "load_new_export, watch (check for new patch notes until stopped and export them), "
+                             "replay (extract and export the patch notes again from the archived pages)")
+    parser.add_argument("output_path",
+                        type=str, help="The output directory")
+    parser.add_argument("-c", "--cache",
+                        help="Use the cached patch note urls (new patch notes will be missing), only effective for load_all",
+                        action="store_true")
+    parser.add_argument("-f", "--force_reload",
+                        help="Reload already (locally) saved patch notes and overwrite those that were changed on the "
+                             "website, only effective for load_all",
+                        action="store_true")
+    parser.add_argument("--resume",
+                        help="Continue an interrupted load_all from its checkpoint instead of loading all overview "
+                             "pages again, only effective for load_all",
+                        action="store_true")
+    parser.add_argument("-url",
+                        help="The url for the patch notes, should contain {index} for the page number",
+                        default="https://www.eveechoes.com/news/updata/index{index}.html")
+    parser.add_argument("-r", "--ratelimit",
+                        help="The delay between http requests in seconds",
+                        default=1, type=float)
+    parser.add_argument("-rd", "--ratelimit_rnd_fac", type=float, default=2,
+                        help="A factor that gets multiplied with a random number between 0 and 1, the result will get "
+                             "added to the rate limit (will be random for every request)")
+    parser.add_argument("-ar", "--adaptive_ratelimit",
+                        help="Adapt the delay between http requests to the server, starting at the rate limit and "
+                             "decreasing down to this minimum delay (in seconds) while the server responds fast and "
+                             "without errors, the random rate limit factor is ignored",
+                        default=None, type=float)
+    parser.add_argument("-mr", "--max_retries",
+                        help="How often a request gets retried after a timeout or a 429/5xx response",
+                        default=3, type=int)
+    parser.add_argument("-i", "--interval",
+                        help="The delay between the checks for new patch notes in seconds, only effective for watch",
+                        default=600, type=float)
+    parser.add_argument("-w", "--workers",
+                        help="The number of parallel downloads, the rate limit is shared between all workers",
+                        default=1, type=int)
+    parser.add_argument("-nhc", "--no_http_cache",
+                        help="Disable the cache for conditional requests of the patch notes overview pages",
+                        action="store_true")
+    parser.add_argument("-na", "--no_archive",
+                        help="Don't save the fetched pages into the response archive (required for replay)",
+                        action="store_true")
+    parser.add_argument("-nfc", "--no_fragment_cache",
+                        help="Format all patch notes again instead of reusing the cached html of unchanged patch notes",
+                        action="store_true")
+    parser.add_argument("-ew", "--export_workers",
+                        help="The number of processes for formatting the patch notes, 0 uses all cpu cores",
+                        default=1, type=int)
+    parser.add_argument("-p", "--parser",
+                        help="The html parser for the downloaded pages, auto uses lxml if it is installed",
+                        choices=["auto"] + html_parser.PARSERS, default="html.parser")
+    parser.add_argument("-fp", "--formatter_parser",
+                        help="The html parser for formatting the patch notes, the parsed patch notes are passed to the "
+                             "export in the combined modes if both parsers are the same",
+                        choices=["auto"] + html_parser.PARSERS, default="html.parser")
+    parser.add_argument("-s", "--storage",
+                        help="Where the patch notes get saved, files saves every patch note as separate file, sqlite "
+                             "saves everything into a single database, pack saves the patch notes compressed into a "
+                             "single file (the existing files get migrated once)",
+                        choices=["files", "sqlite", "pack"], default="files")
+    parser.add_argument("-v", "--verify",
+                        help="Check the saved patch notes for empty or truncated files before loading, broken patch "
+                             "notes get downloaded again by the load modes",
+                        action="store_true")
+    parser.add_argument("-sh", "--shard",
+                        help="Export one html page per year (year) or per N patch notes (a number) and an index page "
+                             "into output_path/html instead of a single html file, only changed pages are written",
+                        default=None, type=shard_type)
+    parser.add_argument("-of", "--output_formats",
+                        help="The formats of the export, all are written from the same formatting pass: html "
+                             "(patch_notes.html), json (patch_notes.jsonl), markdown (patch_notes.md), text "
+                             "(patch_notes.txt) and atom (feed.xml with the newest patch notes)",
+                        nargs="+", default=["html"], choices=["html", "json", "markdown", "text", "atom"])
+    parser.add_argument("-fs", "--feed_size",
+                        help="The number of patch notes in the atom feed",
+                        default=formatter.FEED_SIZE, type=int)
+    parser.add_argument("-j", "--json",
+                        help="Also export the sections and items of every patch note as JSON Lines "
+                             "(patch_notes.jsonl, or one file per page when sharded), same as adding json to -of",
+                        action="store_true")
+    parser.add_argument("-m", "--metrics",
+                        help="Save the timings and counters of the run (requests, downloaded bytes, rate limit sleep, "
+                             "parsing, formatting and writing) as json file",
+                        default=None, type=str)
+    parser.add_argument("-pm", "--prometheus",
+                        help="Save the timings and counters of the run as prometheus textfile",
+                        default=None, type=str)
+    parser.add_argument("--profile",
+                        help="Profile the run and save the report to this file (binary stats if it ends with .prof)",
+                        default=None, type=str)
+    parser.add_argument("-cp", "--copy_to",
+                        help="Copy the generated html to the target path (into the target directory if multiple "
+                             "files are written, only the changed pages of a sharded export)",
+                        default=None, type=str)
+
+    args = parser.parse_args()
+    if args.mode == "replay" and args.no_archive:
+        parser.error("replay requires the response archive")
+    for parser_name in (args.parser, args.formatter_parser):
+        if parser_name != "auto" and not html_parser.is_available(parser_name):
+            parser.error(f"The parser {parser_name} is not installed (pip install {parser_name})")
+    setup(args)
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start_time = datetime.now()
+    start = perf_counter()
+    success = False
+    try:
+        run(args)
+        success = True
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            write_profile(profiler, args.profile)
+        if args.metrics is not None or args.prometheus is not None:
+            write_metrics(args, start_time, perf_counter() - start, success)
+        if scraper.storage is not None:
+            scraper.storage.close()
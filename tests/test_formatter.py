@@ -1,9 +1,34 @@
+import json
+import os
+import tempfile
 import unittest
+from datetime import date
 from typing import List
+from unittest import mock
+from xml.etree import ElementTree
 
 from bs4 import BeautifulSoup, Tag, NavigableString
 
-from ee_patch_notes import formatter
+from benchmarks import corpus
+from ee_patch_notes import formatter, scraper, parser
+from ee_patch_notes.fragments import FragmentCache
+from ee_patch_notes.scraper import PatchNote
+from ee_patch_notes.storage import FileStorage
+
+PATCH_NOTE = """<div class="newDetail">
+<div class="title">Patch Notes<p class="date">{date}</p></div>
+<div class="artCon">
+<p><span style="color:#FF8C00;"><strong>New Content</strong><br/>Structure: Asteroid Detection Array</span><br/>Text</p>
+<p style="margin-left: 40px">Item <b>one</b></p>
+<div><div><span class="x">Lonely text</span></div></div>
+</div>
+</div>"""
+
+
+def _patch_note(time: date) -> PatchNote:
+    patch_note = PatchNote(url=f"https://localhost/news/updata/{time.strftime('%Y%m%d')}/1.html")
+    patch_note.content = PATCH_NOTE.format(date=time.isoformat())
+    return patch_note
 
 
 class SectionHeadingTest(unittest.TestCase):
@@ -109,5 +134,190 @@ class SectionHeadingTest(unittest.TestCase):
             expected_result=["h4"])
 
 
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.out_path = f"{self.tmp.name}/patch_notes.html"
+
+    def test_export(self):
+        notes = [_patch_note(date(2023, 9, 20)), _patch_note(date(2023, 10, 4))]
+        formatter.export_html(notes, self.out_path)
+        with open(self.out_path, "r", encoding="utf-8") as file:
+            soup = BeautifulSoup(file.read(), "html.parser")
+        ids = [tag["id"] for tag in soup.find("div", id="patch-notes").find_all("div", class_="patch-note")]
+        self.assertEqual(["patch-note-2023-10-04", "patch-note-2023-09-20"], ids)
+        self.assertEqual(["h3", "h4"] * 2, [tag.name for tag in soup.find_all(["h3", "h4"])])
+
+    def test_search_index(self):
+        notes = [_patch_note(date(2023, 9, 20)), _patch_note(date(2023, 10, 4))]
+        formatter.export_html(notes, self.out_path)
+        with open(self.out_path, "r", encoding="utf-8") as file:
+            soup = BeautifulSoup(file.read(), "html.parser")
+        index = json.loads(soup.find("script", id="search-index").string)
+        docs = [doc[0] for doc in index["docs"]]
+        for anchor in docs:
+            self.assertIsNotNone(soup.find(id=anchor), f"Anchor {anchor} is missing")
+        # The postings are delta encoded
+        postings = []
+        for delta in index["terms"]["asteroid"]:
+            postings.append(delta + (postings[-1] if len(postings) > 0 else 0))
+        self.assertEqual(["patch-note-2023-10-04-2", "patch-note-2023-09-20-2"], [docs[i] for i in postings])
+        self.assertNotIn("the", index["terms"])
+
+    def test_structured_export(self):
+        notes = [_patch_note(date(2023, 9, 20)), _patch_note(date(2023, 10, 4))]
+        json_path = f"{self.tmp.name}/patch_notes.jsonl"
+        formatter.export_html(notes, self.out_path, json_path=json_path)
+        with open(json_path, "r", encoding="utf-8") as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual(["2023-10-04", "2023-09-20"], [record["date"] for record in records])
+        self.assertEqual(notes[1].url, records[0]["url"])
+        section = records[0]["sections"][0]
+        self.assertEqual(("New Content", "patch-note-2023-10-04-1"), (section["title"], section["anchor"]))
+        self.assertEqual([{"title": "Structure: Asteroid Detection Array", "anchor": "patch-note-2023-10-04-2",
+                           "items": ["Text", "Item one", "Lonely text"]}], section["subsections"])
+
+        out_path = f"{self.tmp.name}/html"
+        formatter.export_sharded(notes, out_path)
+        # The json files are written for unchanged shards once they are requested
+        written = formatter.export_sharded(notes, out_path, structured=True)
+        self.assertEqual(["patch_notes_2023.html", "patch_notes_2023.jsonl", "index.html"],
+                         [os.path.basename(p) for p in written])
+        with open(f"{out_path}/patch_notes_2023.jsonl", "r", encoding="utf-8") as file:
+            self.assertEqual(records, [json.loads(line) for line in file])
+
+    def test_multiple_formats(self):
+        notes = [_patch_note(date(2023, 9, day)) for day in range(1, 4)]
+        notes[0].content = notes[0].content.replace("Text", "Text with *stars* &amp; &lt;tags&gt;")
+        writers = [formatter.HtmlWriter(self.out_path),
+                   formatter.MarkdownWriter(f"{self.tmp.name}/patch_notes.md"),
+                   formatter.TextWriter(f"{self.tmp.name}/patch_notes.txt"),
+                   formatter.FeedWriter(f"{self.tmp.name}/feed.xml", "https://localhost/news", limit=2)]
+        # Every patch note is formatted once for all formats
+        with mock.patch.object(formatter, "render_note", wraps=formatter.render_note) as render_note:
+            formatter.export_notes(notes, writers)
+        self.assertEqual(3, render_note.call_count)
+        with open(self.out_path, "r", encoding="utf-8") as file:
+            self.assertEqual(3, file.read().count('class="patch-note"'))
+        with open(f"{self.tmp.name}/patch_notes.md", "r", encoding="utf-8") as file:
+            markdown = file.read()
+        self.assertIn("## 2023-09-03 Patch Notes\n", markdown)
+        self.assertIn("#### Structure: Asteroid Detection Array\n\n- Text\n- Item one\n", markdown)
+        self.assertIn(r"- Text with \*stars\* & \<tags\>", markdown)
+        with open(f"{self.tmp.name}/patch_notes.txt", "r", encoding="utf-8") as file:
+            text = file.read()
+        self.assertIn("2023-09-01 Patch Notes\n======================\n", text)
+        self.assertIn("New Content\n-----------\n", text)
+
+        feed = ElementTree.parse(f"{self.tmp.name}/feed.xml").getroot()
+        atom = "{http://www.w3.org/2005/Atom}"
+        entries = feed.findall(f"{atom}entry")
+        self.assertEqual([notes[2].url, notes[1].url], [entry.find(f"{atom}id").text for entry in entries])
+        self.assertEqual("2023-09-03T00:00:00Z", feed.find(f"{atom}updated").text)
+        self.assertEqual(formatter.FEED_AUTHOR, feed.find(f"{atom}author/{atom}name").text)
+        self.assertIn('class="patch-note"', entries[0].find(f"{atom}content").text)
+
+        # Only the newest patch notes are formatted for the feed, the other fragments stay cached
+        cache = FragmentCache(f"{self.tmp.name}/fragments", formatter.get_version())
+        formatter.export_notes(notes, [formatter.HtmlWriter(self.out_path)], fragment_cache=cache)
+        cache = FragmentCache(f"{self.tmp.name}/fragments", formatter.get_version())
+        formatter.export_notes(notes, [formatter.FeedWriter(f"{self.tmp.name}/feed.xml", "https://localhost/news",
+                                                            limit=1)], fragment_cache=cache)
+        self.assertEqual((1, 0), (cache.hits, cache.misses))
+        self.assertEqual(3, len(os.listdir(f"{self.tmp.name}/fragments")))
+
+    def test_parallel_export(self):
+        notes = [_patch_note(date(2023, 9, day)) for day in range(1, 6)]
+        results = []
+        for workers in [1, 2]:
+            formatter.export_html(notes, self.out_path, workers=workers)
+            with open(self.out_path, "r", encoding="utf-8") as file:
+                results.append(BeautifulSoup(file.read(), "html.parser").find("div", id="patch-notes").decode())
+        self.assertEqual(results[0], results[1])
+
+    def test_lazy_content(self):
+        notes = []
+        for day in range(1, 4):
+            note = _patch_note(date(2023, 9, day))
+            note.save_content(f"{self.tmp.name}/patch_notes_{note.time.isoformat()}.html")
+            note.release_content()
+            notes.append(note)
+        with mock.patch.object(scraper, "DOWNLOAD_PATH", self.tmp.name):
+            formatter.export_html(notes, self.out_path)
+        with open(self.out_path, "r", encoding="utf-8") as file:
+            self.assertEqual(3, file.read().count('class="patch-note"'))
+        self.assertFalse(any(note.content_loaded for note in notes))
+
+    def test_fragment_cache(self):
+        cache = FragmentCache(f"{self.tmp.name}/fragments", formatter.get_version())
+        notes = [_patch_note(date(2023, 9, 20)), _patch_note(date(2023, 10, 4))]
+        formatter.export_html(notes, self.out_path, fragment_cache=cache)
+        with open(self.out_path, "r", encoding="utf-8") as file:
+            expected = file.read()
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+
+        cache = FragmentCache(f"{self.tmp.name}/fragments", formatter.get_version())
+        formatter.export_html(notes, self.out_path, fragment_cache=cache)
+        with open(self.out_path, "r", encoding="utf-8") as file:
+            self.assertEqual(expected, file.read())
+        self.assertEqual((2, 0), (cache.hits, cache.misses))
+
+        # Changed content must invalidate the fragment, outdated fragments get removed
+        notes[0].content = notes[0].content.replace("Text", "Changed")
+        cache = FragmentCache(f"{self.tmp.name}/fragments", formatter.get_version())
+        formatter.export_html(notes, self.out_path, fragment_cache=cache)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual(2, len(os.listdir(f"{self.tmp.name}/fragments")))
+
+    def test_parsed_content(self):
+        # The parsed content of a downloaded patch note must give the same result as parsing the saved content
+        notes = corpus.generate_notes(10, sections=4)
+        for page_parser in sorted({"html.parser", parser.DEFAULT_PARSER}):
+            with mock.patch.object(parser, "HTML_PARSER", page_parser), \
+                    mock.patch.object(parser, "FORMATTER_PARSER", page_parser), \
+                    mock.patch.object(scraper, "KEEP_PARSED", True):
+                for note in notes:
+                    patch_note = PatchNote(note.url)
+                    scraper.extract_patch_note(patch_note, note.page.encode("utf-8"))
+                    self.assertIsNotNone(patch_note.parsed)
+                    result = formatter.render_note(patch_note)
+                    self.assertIsNone(patch_note.parsed)
+                    self.assertEqual(formatter.render_note(patch_note), result)
+
+    def test_sharded_export(self):
+        out_path = f"{self.tmp.name}/html"
+        notes = [_patch_note(date(2022, 12, 1)), _patch_note(date(2023, 9, 20)), _patch_note(date(2023, 10, 4))]
+        written = formatter.export_sharded(notes, out_path)
+        self.assertEqual(["patch_notes_2023.html", "patch_notes_2022.html", "index.html"],
+                         [os.path.basename(p) for p in written])
+        with open(f"{out_path}/index.html", "r", encoding="utf-8") as file:
+            soup = BeautifulSoup(file.read(), "html.parser")
+        links = [a["href"] for a in soup.find("div", id="patch-notes").find_all("a")]
+        self.assertIn("patch_notes_2023.html#patch-note-2023-10-04", links)
+        index = json.loads(soup.find("script", id="search-index").string)
+        self.assertIn("patch_notes_2022.html#patch-note-2022-12-01", [doc[0] for doc in index["docs"]])
+
+        # Only the shard with the changed patch note gets written again
+        self.assertEqual([f"{out_path}/index.html"], formatter.export_sharded(notes, out_path))
+        notes[0].content = notes[0].content.replace("Text", "Changed")
+        self.assertEqual(["patch_notes_2022.html", "index.html"],
+                         [os.path.basename(p) for p in formatter.export_sharded(notes, out_path)])
+
+        # The digests of saved patch notes are built from the hashes of the storage without loading the content
+        files = FileStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        for note in notes:
+            files.save_content(note.time.isoformat(), note.content)
+        saved = [PatchNote(note.url) for note in notes]
+        with mock.patch.object(scraper, "storage", files):
+            formatter.export_sharded(saved, out_path)
+            with mock.patch.object(files, "load_content", side_effect=AssertionError("Content was loaded")):
+                self.assertEqual([f"{out_path}/index.html"], formatter.export_sharded(saved, out_path))
+
+        formatter.export_sharded(notes, out_path, shard_size=2)
+        self.assertEqual(["index.html", "patch_notes_1.html", "patch_notes_2.html", "shards.json"],
+                         sorted(os.listdir(out_path)))
+
+
 if __name__ == '__main__':
     unittest.main()
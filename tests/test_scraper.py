@@ -0,0 +1,592 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from time import monotonic
+from unittest import mock
+
+import requests
+from requests import Response
+
+from benchmarks import corpus
+from benchmarks.server import PatchNoteServer
+from ee_patch_notes import scraper, formatter, parser
+from ee_patch_notes.archive import ResponseArchive
+from ee_patch_notes.http_cache import HttpCache
+from ee_patch_notes.metrics import Metrics
+from ee_patch_notes.storage import FileStorage, SQLiteStorage, PackStorage, content_hash, migrate, \
+    migrate_to_sqlite, migrate_to_pack
+
+PATCH_NOTE_PAGE = """
+<html><body><div class="wrap"><div class="newDetail">
+<div class="title">Patch Notes<p class="date">2023-09-20</p></div>
+<div class="artCon"><p>Content</p></div>
+</div></div></body></html>
+"""
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_spacing(self):
+        limiter = scraper.RateLimiter(delay=0.05, rand_fac=0)
+        self.assertEqual(0, limiter.reserve())
+        self.assertAlmostEqual(0.05, limiter.reserve(), delta=0.01)
+        self.assertAlmostEqual(0.10, limiter.reserve(), delta=0.01)
+
+    def test_shared_between_threads(self):
+        limiter = scraper.RateLimiter(delay=0.02, rand_fac=0)
+        times = []
+        lock = threading.Lock()
+
+        def _worker():
+            for _ in range(3):
+                limiter.acquire()
+                with lock:
+                    times.append(monotonic())
+
+        threads = [threading.Thread(target=_worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        times.sort()
+        for a, b in zip(times, times[1:]):
+            self.assertGreaterEqual(b - a, 0.015)
+
+    def test_adaptive(self):
+        limiter = scraper.AdaptiveRateLimiter(min_delay=0.1, max_delay=1, start_delay=0.5, step=0.1, jitter=0)
+        for _ in range(6):
+            limiter.report(0.05, True)
+        self.assertAlmostEqual(0.1, limiter.current_delay)
+        limiter.report(0.05, False)
+        self.assertAlmostEqual(0.2, limiter.current_delay)
+        # Rising response times count as overload
+        for _ in range(5):
+            limiter.report(1, True)
+        self.assertAlmostEqual(1, limiter.current_delay)
+
+    def test_pause(self):
+        limiter = scraper.RateLimiter(delay=0.01, rand_fac=0)
+        limiter.pause(0.2)
+        self.assertAlmostEqual(0.2, limiter.reserve(), delta=0.02)
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        for name, value in [("limiter", scraper.RateLimiter(0, 0)), ("http_cache", None), ("RETRY_BACKOFF", 0)]:
+            patcher = mock.patch.object(scraper, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_retry(self):
+        responses = [_response(503, headers={"Retry-After": "0"}), _response(429), _response(200, b"body")]
+        with mock.patch.object(scraper.session, "get", side_effect=responses) as get:
+            self.assertEqual(b"body", scraper.fetch_page("https://localhost/").content)
+        self.assertEqual(3, get.call_count)
+
+    def test_give_up(self):
+        with mock.patch.object(scraper.session, "get", side_effect=requests.Timeout()) as get:
+            with self.assertRaises(scraper.WebScrapeException):
+                scraper.fetch_page("https://localhost/")
+        self.assertEqual(scraper.MAX_RETRIES + 1, get.call_count)
+
+    def test_no_retry(self):
+        with mock.patch.object(scraper.session, "get", return_value=_response(404)) as get:
+            self.assertEqual(404, scraper.fetch_page("https://localhost/").status_code)
+        self.assertEqual(1, get.call_count)
+
+    def test_retry_after(self):
+        self.assertEqual(5, scraper._parse_retry_after("5"))
+        self.assertEqual(0, scraper._parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"))
+        self.assertIsNone(scraper._parse_retry_after("soon"))
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.metrics = Metrics()
+        for name, value in [("limiter", scraper.RateLimiter(0, 0)), ("http_cache", None), ("RETRY_BACKOFF", 0),
+                            ("metrics", self.metrics)]:
+            patcher = mock.patch.object(scraper, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_fetch_metrics(self):
+        responses = [_response(503), _response(200, b"body")]
+        with mock.patch.object(scraper.session, "get", side_effect=responses):
+            scraper.fetch_page("https://localhost/")
+        data = self.metrics.to_dict()
+        self.assertEqual({"requests": 2, "request_errors": 1, "retries": 1, "bytes_downloaded": 4}, data["counters"])
+        self.assertEqual(2, data["timers"]["fetch"]["count"])
+
+    def test_prometheus(self):
+        self.metrics.inc("requests", 3)
+        self.metrics.observe("fetch", 0.5)
+        self.metrics.observe("fetch", 1.5)
+        self.metrics.write_prometheus(f"{self.tmp.name}/metrics.prom")
+        with open(f"{self.tmp.name}/metrics.prom", "r", encoding="utf-8") as file:
+            lines = file.read().splitlines()
+        self.assertIn("ee_patch_notes_requests_total 3", lines)
+        self.assertIn("ee_patch_notes_fetch_seconds_count 2", lines)
+        self.assertIn("ee_patch_notes_fetch_seconds_sum 2.0", lines)
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.object(scraper, "DOWNLOAD_PATH", self.tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrent_download(self):
+        notes = [scraper.PatchNote(f"https://localhost/news/updata/202309{d:02}/1.html") for d in range(1, 9)]
+        response = mock.Mock(content=PATCH_NOTE_PAGE.encode("utf-8"))
+        with mock.patch.object(scraper, "fetch_page", return_value=response) as fetch:
+            scraper.download_all_patch_notes(notes, workers=4)
+        self.assertEqual(8, fetch.call_count)
+        for note in notes:
+            path = f"{self.tmp.name}/patch_notes_{note.time.isoformat()}.html"
+            self.assertTrue(os.path.exists(path))
+            self.assertIn("artCon", note.content)
+
+    def test_session_per_thread(self):
+        sessions = []
+        threads = [threading.Thread(target=lambda: sessions.extend([scraper.get_session()] * 2)) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertIs(sessions[0], sessions[1])
+        self.assertEqual(3, len({id(s) for s in sessions + [scraper.get_session()]}))
+        self.assertIs(scraper.session, scraper.get_session())
+
+
+class SyntheticCorpusTest(unittest.TestCase):
+    def test_listing_page(self):
+        notes = corpus.generate_notes(25)
+        pages = corpus.paginate(notes)
+        raw = corpus.generate_listing_page(pages[1], 2, len(pages))
+        with mock.patch.object(scraper, "fetch_page", return_value=mock.Mock(content=raw.encode("utf-8"))):
+            self.assertEqual(3, scraper.load_page_range(corpus.index_url(1)))
+            patch_notes = scraper.extract_patch_notes_urls(corpus.index_url(2))
+        self.assertEqual([(n.url, n.time) for n in pages[1]], [(p.url, p.time) for p in patch_notes])
+
+    def test_patch_note_page(self):
+        note = corpus.generate_notes(1)[0]
+        patch_note = scraper.PatchNote(note.url)
+        scraper.extract_patch_note(patch_note, note.page.encode("utf-8"))
+        self.assertEqual(note.time, patch_note.time)
+        self.assertTrue(patch_note.content.startswith('<div class="newDetail">'))
+
+
+class LocalServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = PatchNoteServer(notes=23, per_page=5, sections=2)
+        self.server.start_background()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for name, value in [("DOWNLOAD_PATH", self.tmp.name), ("CACHE_PATH", f"{self.tmp.name}/cache.jsonl"),
+                            ("limiter", scraper.RateLimiter(0, 0)), ("http_cache", None)]:
+            patcher = mock.patch.object(scraper, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_load_all(self):
+        last_page = scraper.load_page_range(self.server.url_template.format(index=""))
+        self.assertEqual(5, last_page)
+        patch_notes = scraper.find_all_patch_notes_urls(self.server.url_template, last_page)
+        self.assertEqual(23, len(patch_notes))
+        scraper.download_all_patch_notes(patch_notes, workers=3)
+        self.assertFalse(scraper.has_missing_notes(patch_notes))
+
+    def test_load_new(self):
+        patch_notes = scraper.find_all_patch_notes_urls(self.server.url_template, self.server.last_page)
+        scraper.download_all_patch_notes(patch_notes)
+        self.server.set_notes(25)
+        requests = self.server.requests
+        scraper.download_new_patch_notes(self.server.url_template, stop_at=self.server.last_page)
+        # Page 1 contains the new patch notes and already saved ones
+        self.assertEqual(1 + 2, self.server.requests - requests)
+        self.assertEqual(25, len(scraper.load_patch_notes_from_cache()))
+
+    def test_load_new_boundary_search(self):
+        patch_notes = scraper.find_all_patch_notes_urls(self.server.url_template, self.server.last_page)
+        scraper.download_all_patch_notes(patch_notes)
+        # Missing old patch notes must not lead to a search through all pages
+        for patch_note in patch_notes[-8:]:
+            os.remove(f"{self.tmp.name}/patch_notes_{patch_note.time.isoformat()}.html")
+        self.server.set_notes(40)
+        requests = self.server.requests
+        scraper.download_new_patch_notes(self.server.url_template, stop_at=self.server.last_page)
+        # Pages 1 to 4 contain the new patch notes, the boundary (page 4) is found via the pages 1, 2, 4 and 3
+        self.assertEqual(4 + 17, self.server.requests - requests)
+        self.assertEqual(40, len(scraper.load_patch_notes_from_cache()))
+
+    def test_watch(self):
+        patch_notes = scraper.find_all_patch_notes_urls(self.server.url_template, self.server.last_page)
+        scraper.download_all_patch_notes(patch_notes)
+        scraper.save_patch_note_cache(patch_notes)
+        with mock.patch.object(scraper, "http_cache", HttpCache(f"{self.tmp.name}/http_cache")):
+            watcher = scraper.PatchNoteWatcher(self.server.url_template)
+            self.assertEqual([], watcher.poll())
+            requests = self.server.requests
+            self.assertEqual([], watcher.poll())
+            self.assertEqual(1, self.server.requests - requests)
+            self.server.set_notes(25)
+            requests = self.server.requests
+            self.assertEqual(2, len(watcher.poll()))
+            # Only page 1 and the new patch notes
+            self.assertEqual(1 + 2, self.server.requests - requests)
+            self.server.set_notes(33)
+            self.assertEqual(8, len(watcher.poll()))
+        self.assertEqual(33, len(watcher.patch_notes))
+        self.assertEqual(33, len(scraper.load_patch_notes_from_cache()))
+        self.assertFalse(scraper.has_missing_notes(watcher.patch_notes))
+
+    def test_export_handoff(self):
+        patch_notes = scraper.find_all_patch_notes_urls(self.server.url_template, self.server.last_page)
+        scraper.download_all_patch_notes(patch_notes)
+        self.server.set_notes(25)
+        # The parsed patch notes are only passed to the formatter if both use the same parser
+        with mock.patch.object(scraper, "KEEP_PARSED", True), mock.patch.object(parser, "HTML_PARSER", "html.parser"):
+            new_notes = scraper.download_new_patch_notes(self.server.url_template, stop_at=self.server.last_page)
+        self.assertEqual(2, len(new_notes))
+        self.assertTrue(all(p.parsed is not None for p in new_notes))
+        formatter.export_html(new_notes + patch_notes, f"{self.tmp.name}/patch_notes.html")
+        # The content of all patch notes is released once they are formatted
+        self.assertFalse(any(p.content_loaded or p.parsed is not None for p in new_notes + patch_notes))
+
+    def test_force_reload(self):
+        patch_notes = scraper.find_all_patch_notes_urls(self.server.url_template, self.server.last_page)
+        scraper.download_all_patch_notes(patch_notes)
+        self.server.edit_note(patch_notes[3].url)
+        storage = FileStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        with mock.patch.object(FileStorage, "save_content", autospec=True,
+                               side_effect=FileStorage.save_content) as save:
+            edited = scraper.download_all_patch_notes(patch_notes, skip_existing=False, workers=2, only_changed=True)
+        self.assertEqual([patch_notes[3]], edited)
+        self.assertEqual(1, save.call_count)
+        self.assertIn("<p>Edited</p>", storage.load_content(patch_notes[3].time.isoformat()))
+
+    def test_resume(self):
+        path = f"{self.tmp.name}/load_all.checkpoint.jsonl"
+
+        def _interrupt_after(func, calls):
+            def _wrapper(*args):
+                if _wrapper.calls == calls:
+                    raise scraper.WebScrapeException("Interrupted")
+                _wrapper.calls += 1
+                return func(*args)
+            _wrapper.calls = 0
+            return _wrapper
+
+        checkpoint = scraper.LoadCheckpoint(path)
+        checkpoint.open(self.server.url_template, resume=False)
+        with mock.patch.object(scraper, "extract_patch_notes_urls",
+                               _interrupt_after(scraper.extract_patch_notes_urls, 2)):
+            with self.assertRaises(scraper.WebScrapeException):
+                scraper.find_all_patch_notes_urls(self.server.url_template, 5, checkpoint=checkpoint)
+        checkpoint.close()
+
+        checkpoint = scraper.LoadCheckpoint(path)
+        checkpoint.open(self.server.url_template, resume=True)
+        requests = self.server.requests
+        patch_notes = scraper.find_all_patch_notes_urls(self.server.url_template, 5, checkpoint=checkpoint)
+        self.assertEqual(3, self.server.requests - requests)
+        self.assertEqual(23, len(patch_notes))
+        with mock.patch.object(scraper, "download_patch_note", _interrupt_after(scraper.download_patch_note, 4)):
+            with self.assertRaises(scraper.WebScrapeException):
+                scraper.download_all_patch_notes(patch_notes, skip_existing=False, checkpoint=checkpoint)
+        checkpoint.close()
+
+        checkpoint = scraper.LoadCheckpoint(path)
+        checkpoint.open(self.server.url_template, resume=True)
+        requests = self.server.requests
+        self.assertEqual(23, len(scraper.find_all_patch_notes_urls(self.server.url_template, 5,
+                                                                    checkpoint=checkpoint)))
+        scraper.download_all_patch_notes(patch_notes, skip_existing=False, checkpoint=checkpoint)
+        self.assertEqual(23 - 4, self.server.requests - requests)
+        checkpoint.finish()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(scraper.has_missing_notes(patch_notes))
+
+    def test_unreadable_checkpoint(self):
+        path = f"{self.tmp.name}/load_all.checkpoint.jsonl"
+        with open(path, "w", encoding="utf-8") as file:
+            file.write('{"url": "https://other.localhost/ind\n')
+            file.write(json.dumps({"page": 1, "notes": [{"url": "a", "time": "2023-09-20"}]}) + "\n")
+            file.write(json.dumps({"done": "2023-09-20"}) + "\n")
+        # The source of the checkpoint is unknown, it must not be resumed
+        checkpoint = scraper.LoadCheckpoint(path)
+        checkpoint.open("https://localhost/news/updata/index{index}.html", resume=True)
+        checkpoint.close()
+        self.assertEqual(({}, set()), (checkpoint.pages, checkpoint.done))
+
+    def test_replay(self):
+        archive = ResponseArchive(f"{self.tmp.name}/archive")
+        with mock.patch.object(scraper, "archive", archive):
+            last_page = scraper.load_page_range(self.server.url_template.format(index=""))
+            patch_notes = scraper.find_all_patch_notes_urls(self.server.url_template, last_page)
+            scraper.download_all_patch_notes(patch_notes)
+            # Unchanged pages are not saved again
+            size = os.path.getsize(archive.pack_path)
+            scraper.extract_patch_notes_urls(self.server.url_template.format(index=""))
+            self.assertEqual(size, os.path.getsize(archive.pack_path))
+        self.assertEqual(1 + 5 + 23 + 1, archive.records)
+        os.remove(f"{self.tmp.name}/patch_notes_{patch_notes[0].time.isoformat()}.html")
+        requests = self.server.requests
+        with mock.patch.object(scraper, "archive", ResponseArchive(f"{self.tmp.name}/archive")), \
+                mock.patch.object(scraper, "REPLAY", True):
+            scraper.replay_patch_notes(self.server.url_template)
+        self.assertEqual(0, self.server.requests - requests)
+        self.assertFalse(scraper.has_missing_notes(patch_notes))
+        self.assertEqual(23, len(scraper.load_patch_notes_from_cache()))
+
+    def test_replay_not_modified(self):
+        # The overview pages are answered with 304 Not Modified once the http cache is warm
+        with mock.patch.object(scraper, "http_cache", HttpCache(f"{self.tmp.name}/http_cache")):
+            last_page = scraper.load_page_range(self.server.url_template.format(index=""))
+            scraper.find_all_patch_notes_urls(self.server.url_template, last_page, cache=False)
+            archive = ResponseArchive(f"{self.tmp.name}/archive")
+            with mock.patch.object(scraper, "archive", archive), mock.patch.object(scraper, "metrics", Metrics()):
+                last_page = scraper.load_page_range(self.server.url_template.format(index=""))
+                patch_notes = scraper.find_all_patch_notes_urls(self.server.url_template, last_page, cache=False)
+                scraper.download_all_patch_notes(patch_notes)
+                self.assertEqual(1 + 5, scraper.metrics.to_dict()["counters"]["not_modified"])
+        requests = self.server.requests
+        with mock.patch.object(scraper, "archive", ResponseArchive(f"{self.tmp.name}/archive")), \
+                mock.patch.object(scraper, "REPLAY", True):
+            scraper.replay_patch_notes(self.server.url_template)
+        self.assertEqual(0, self.server.requests - requests)
+        self.assertEqual(23, len(scraper.load_patch_notes_from_cache()))
+
+
+def _response(status: int, body: bytes = b"", headers=None) -> Response:
+    response = Response()
+    response.status_code = status
+    response._content = body
+    response.headers.update(headers or {})
+    return response
+
+
+class HttpCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for name, value in [("http_cache", HttpCache(self.tmp.name)), ("limiter", scraper.RateLimiter(0, 0))]:
+            patcher = mock.patch.object(scraper, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_not_modified(self):
+        url = "https://localhost/news/updata/index.html"
+        with mock.patch.object(scraper.session, "get", return_value=_response(200, b"body", {"ETag": "\"a\""})):
+            self.assertEqual(b"body", scraper.fetch_page(url, use_cache=True).content)
+        scraper.http_cache.set_meta(url, "key", 42)
+        with mock.patch.object(scraper.session, "get", return_value=_response(304)) as get:
+            page = scraper.fetch_page(url, use_cache=True)
+        self.assertEqual("\"a\"", get.call_args.kwargs["headers"]["If-None-Match"])
+        self.assertEqual(b"body", page.content)
+        self.assertEqual(42, scraper._get_cached_result(url, page, "key"))
+        # The cache must survive a restart
+        self.assertEqual({"If-None-Match": "\"a\""}, HttpCache(self.tmp.name).request_headers(url))
+
+    def test_modified(self):
+        url = "https://localhost/news/updata/index.html"
+        with mock.patch.object(scraper.session, "get", return_value=_response(200, b"old", {"ETag": "a"})):
+            scraper.fetch_page(url, use_cache=True)
+        scraper.http_cache.set_meta(url, "key", 42)
+        with mock.patch.object(scraper.session, "get", return_value=_response(200, b"new", {"ETag": "b"})):
+            page = scraper.fetch_page(url, use_cache=True)
+        self.assertEqual(b"new", page.content)
+        self.assertIsNone(scraper._get_cached_result(url, page, "key"))
+
+
+class StorageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.db = SQLiteStorage(f"{self.tmp.name}/patch_notes.db")
+        self.addCleanup(self.db.close)
+
+    def test_sqlite_storage(self):
+        notes = [scraper.PatchNote(f"https://localhost/news/updata/202309{d:02}/1.html") for d in range(1, 4)]
+        response = mock.Mock(content=PATCH_NOTE_PAGE.encode("utf-8"))
+        with mock.patch.object(scraper, "storage", self.db), \
+                mock.patch.object(scraper, "fetch_page", return_value=response) as fetch:
+            scraper.save_patch_note_cache(notes)
+            scraper.download_all_patch_notes(notes)
+            scraper.download_all_patch_notes(notes)
+            self.assertEqual(3, fetch.call_count)
+            self.assertFalse(scraper.has_missing_notes(notes))
+            loaded = scraper.load_patch_notes_from_cache()
+            scraper.load_patch_notes_content(loaded)
+            # Replacing the metadata keeps the content
+            scraper.save_patch_note_cache(notes[:1])
+            self.assertEqual(1, len(scraper.load_patch_notes_from_cache()))
+        self.assertEqual(sorted(n.time for n in notes), sorted(p.time for p in loaded))
+        self.assertTrue(all("artCon" in p.content for p in loaded))
+        self.assertEqual({n.time.isoformat() for n in notes}, self.db.content_keys())
+        with self.assertRaises(KeyError):
+            self.db.load_content("2023-10-01")
+
+    def test_content_hashes(self):
+        contents = {"2023-09-20": "<div>a</div>", "2023-09-13": "<div>ü</div>"}
+        files = FileStorage(f"{self.tmp.name}/files", f"{self.tmp.name}/files/cache.jsonl")
+        os.makedirs(files.path)
+        pack = PackStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        self.addCleanup(pack.close)
+        for target in [files, self.db, pack]:
+            target.save_contents(contents)
+        expected = {key: content_hash(content) for key, content in contents.items()}
+        for target in [files, self.db, pack]:
+            self.assertEqual(expected, target.content_hashes())
+
+    def test_manifest(self):
+        files = FileStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        files.save_contents({"2023-09-20": "<div>a</div>", "2023-09-13": "<div>b</div>", "2023-09-06": "<div>c</div>"})
+        self.assertEqual({"2023-09-20", "2023-09-13", "2023-09-06"}, files.content_keys())
+        files.content_hashes()
+        files.close()
+        reopened = FileStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        with mock.patch.object(reopened, "load_content") as load:
+            self.assertEqual(content_hash("<div>b</div>"), reopened.content_hashes()["2023-09-13"])
+        load.assert_not_called()
+        self.assertEqual(12, reopened.manifest.size("2023-09-20"))
+        self.assertEqual([], reopened.check_integrity())
+        # Files that got truncated or emptied outside the storage
+        with open(f"{self.tmp.name}/patch_notes_2023-09-20.html", "w", encoding="utf-8") as file:
+            file.write("<div><div>a</div>")
+        with open(f"{self.tmp.name}/patch_notes_2023-09-06.html", "w", encoding="utf-8"):
+            pass
+        self.assertEqual(["2023-09-06", "2023-09-20"],
+                         FileStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl").check_integrity())
+
+    def test_pack_storage(self):
+        pack = PackStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        pack.save_contents({"2023-09-20": "<div>a</div>" * 100, "2023-09-13": "<div>b</div>"})
+        for _ in range(3):
+            pack.save_content("2023-09-20", "<div>c</div>" * 100)
+        self.assertEqual("<div>c</div>" * 100, pack.load_content("2023-09-20"))
+        pack.close()
+        # Only the latest content remains after the compaction
+        reopened = PackStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        self.addCleanup(reopened.close)
+        self.assertEqual({"2023-09-20": "<div>c</div>" * 100, "2023-09-13": "<div>b</div>"},
+                         reopened.load_contents(["2023-09-20", "2023-09-13"]))
+        self.assertEqual(["patch_notes.1.pack"], [f for f in os.listdir(self.tmp.name) if f.endswith(".pack")])
+        with self.assertRaises(KeyError):
+            reopened.load_content("2023-10-01")
+
+    def test_pack_index_on_close(self):
+        pack = PackStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        save_index = PackStorage._save_index
+        with mock.patch.object(PackStorage, "_save_index", autospec=True, side_effect=save_index) as save:
+            for day in range(1, 6):
+                pack.save_content(f"2023-09-{day:02}", f"<div>{day}</div>")
+            save.assert_not_called()
+            pack.close()
+            save.assert_called_once()
+        reopened = PackStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        self.addCleanup(reopened.close)
+        self.assertEqual(5, len(reopened.content_keys()))
+
+    def test_lazy_content(self):
+        pack = PackStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        self.addCleanup(pack.close)
+        pack.save_meta([{"url": "https://localhost/news/updata/20230920/1.html", "time": "2023-09-20"}])
+        pack.save_content("2023-09-20", "<div>a</div>")
+        with mock.patch.object(scraper, "storage", pack):
+            patch_note = scraper.load_patch_notes_from_cache()[0]
+            self.assertFalse(patch_note.content_loaded)
+            self.assertEqual("<div>a</div>", patch_note.content)
+            self.assertTrue(patch_note.content_loaded)
+            patch_note.release_content()
+            self.assertFalse(patch_note.content_loaded)
+            self.assertIsNone(scraper.PatchNote("https://localhost/news/updata/20231001/1.html").content)
+
+    def test_meta_journal(self):
+        files = FileStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        files.save_meta([{"url": "a", "time": "2023-09-20"}])
+        files.append_meta([{"url": "b", "time": "2023-09-27"}])
+        files.append_meta([{"url": "c", "time": "2023-09-20"}])
+        # An interrupted write leaves an incomplete record
+        with open(files.cache_path, "a", encoding="utf-8") as file:
+            file.write('{"url": "d", "ti')
+        files.append_meta([{"url": "e", "time": "2023-10-04"}])
+        self.assertEqual({"2023-09-20": "c", "2023-09-27": "b", "2023-10-04": "e"},
+                         {e["time"]: e["url"] for e in files.load_meta()})
+
+    def test_meta_journal_compaction(self):
+        files = FileStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        for i in range(150):
+            files.append_meta([{"url": str(i), "time": "2023-09-20"}])
+        self.assertEqual([{"url": "149", "time": "2023-09-20"}], files.load_meta())
+        with open(files.cache_path, "r", encoding="utf-8") as file:
+            self.assertEqual(1, len(file.readlines()))
+
+    def test_legacy_meta_cache(self):
+        with open(f"{self.tmp.name}/cache.json", "w", encoding="utf-8") as file:
+            json.dump({"2023-09-20": {"url": "a", "time": "2023-09-20"}}, file)
+        files = FileStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        self.assertEqual([{"url": "a", "time": "2023-09-20"}], files.load_meta())
+        files.append_meta([{"url": "b", "time": "2023-09-27"}])
+        self.assertEqual(2, len(FileStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl").load_meta()))
+
+    def test_migrate(self):
+        files = FileStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        files.save_meta([{"url": "https://localhost/news/updata/20230920/1.html", "time": "2023-09-20"}])
+        files.save_content("2023-09-20", "<div>a</div>")
+        files.save_content("2023-09-13", "<div>b</div>")
+        migrate(files, self.db)
+        self.assertEqual(files.load_meta(), self.db.load_meta())
+        self.assertEqual({"2023-09-20": "<div>a</div>", "2023-09-13": "<div>b</div>"},
+                         self.db.load_contents(["2023-09-20", "2023-09-13"]))
+
+    def test_interrupted_migration(self):
+        files = FileStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        files.save_meta([{"url": "https://localhost/news/updata/20230920/1.html", "time": "2023-09-20"}])
+        for day in range(1, 6):
+            files.save_content(f"2023-09-{day:02}", f"<div>{day}</div>")
+        db_path = f"{self.tmp.name}/migrated.db"
+        with mock.patch.object(SQLiteStorage, "save_contents", side_effect=OSError("Interrupted")):
+            with self.assertRaises(OSError):
+                migrate_to_sqlite(files, db_path)
+        # The partial database must not be taken for a complete one
+        self.assertFalse(os.path.exists(db_path))
+        migrate_to_sqlite(files, db_path)
+        db = SQLiteStorage(db_path)
+        self.addCleanup(db.close)
+        self.assertEqual(5, len(db.load_contents(f"2023-09-{day:02}" for day in range(1, 6))))
+
+        save_contents = PackStorage.save_contents
+
+        def _interrupted(storage, contents):
+            save_contents(storage, contents)
+            raise OSError("Interrupted")
+
+        with mock.patch.object(PackStorage, "save_contents", autospec=True, side_effect=_interrupted):
+            with self.assertRaises(OSError):
+                migrate_to_pack(files, self.tmp.name, files.cache_path)
+        self.assertTrue(os.path.exists(f"{self.tmp.name}/patch_notes.0.pack"))
+        self.assertFalse(os.path.exists(f"{self.tmp.name}/patch_notes.idx"))
+        migrate_to_pack(files, self.tmp.name, files.cache_path)
+        pack = PackStorage(self.tmp.name, files.cache_path)
+        self.addCleanup(pack.close)
+        self.assertEqual(5, len(pack.content_keys()))
+
+    def test_empty_migration(self):
+        files = FileStorage(self.tmp.name, f"{self.tmp.name}/cache.jsonl")
+        migrate_to_pack(files, self.tmp.name, files.cache_path)
+        self.assertTrue(os.path.exists(f"{self.tmp.name}/patch_notes.idx"))
+        pack = PackStorage(self.tmp.name, files.cache_path)
+        self.addCleanup(pack.close)
+        self.assertEqual(set(), pack.content_keys())
+
+
+if __name__ == '__main__':
+    unittest.main()